@@ -0,0 +1,198 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import benchmark_utils
+import check_model
+import json
+from model_handle import ModelHandle
+import numpy as np
+import os
+import perf_store
+import result_cache
+import sys
+import test_utils
+
+
+MANIFEST_FILE = "ONNX_HUB_MANIFEST.json"
+SWEEP_FILE = "ci_batch_sweep.jsonl"
+# element types of the io_ports in the manifest, as reported by onnxruntime
+PORT_TYPE_TO_NP_TYPE = {
+    "tensor(float)": np.float32,
+    "tensor(double)": np.float64,
+    "tensor(float16)": np.float16,
+    "tensor(int8)": np.int8,
+    "tensor(int16)": np.int16,
+    "tensor(int32)": np.int32,
+    "tensor(int64)": np.int64,
+    "tensor(uint8)": np.uint8,
+    "tensor(uint16)": np.uint16,
+    "tensor(bool)": np.bool_,
+}
+
+
+def get_batch_axes(inputs):
+    """Return a map of input name to the index of its batch axis, or None if no input has a dynamic batch axis.
+    The batch axis is the leading axis when it is symbolic, e.g. "N", "batch_size" or "unk__492". Inputs with a
+    fixed leading axis, e.g. the shape of an image size input, keep their shape at every batch size."""
+    batch_axes = {}
+    for port in inputs:
+        shape = port["shape"]
+        if shape and not isinstance(shape[0], int):
+            batch_axes[port["name"]] = 0
+    return batch_axes or None
+
+
+def create_batch_inputs(inputs, batch_axes, batch_size, symbolic_dim_values_map, seed=0):
+    """Create random data for the inputs at a batch size. Symbolic dims other than the batch axis are taken from
+    symbolic_dim_values_map, or 1 like ort_test_dir_utils does for missing test data."""
+    rng = np.random.default_rng(seed)
+    name_input_map = {}
+    for port in inputs:
+        if port["type"] not in PORT_TYPE_TO_NP_TYPE:
+            raise ValueError("Unsupported input type {} of {}".format(port["type"], port["name"]))
+        np_type = PORT_TYPE_TO_NP_TYPE[port["type"]]
+        dims = []
+        for axis, dim in enumerate(port["shape"]):
+            if batch_axes.get(port["name"]) == axis:
+                dims.append(batch_size)
+            elif isinstance(dim, int):
+                dims.append(dim)
+            else:
+                dims.append(symbolic_dim_values_map.get(dim, 1))
+        if np.issubdtype(np_type, np.floating):
+            data = rng.standard_normal(dims).astype(np_type)
+        elif np_type == np.bool_:
+            data = rng.integers(0, 2, dims).astype(np_type)
+        else:
+            # small values so that ids and indices stay in range, e.g. of token embeddings
+            data = rng.integers(0, 10, dims).astype(np_type)
+        name_input_map[port["name"]] = data
+    return name_input_map
+
+
+def reset_peak_rss():
+    # on Linux, writing 5 to clear_refs resets the peak RSS (VmHWM) of the process
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss_mb():
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    # otherwise the peak of the whole run so far; kilobytes on Linux, bytes on macOS
+    import resource  # not available on Windows
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def sweep_model(model, io_ports, args):
+    """Measure the latency, throughput and peak RSS of a model at batch sizes 1, 2, 4 ... until the next batch
+    size would exceed args.max_batch_size or the peak RSS reaches args.max_memory_mb. Return the records."""
+    batch_axes = get_batch_axes(io_ports["inputs"])
+    if batch_axes is None:
+        print("Skip {} because none of its inputs has a dynamic batch axis".format(model.model_path))
+        return []
+    sess = model.session
+    output_names = [output.name for output in sess.get_outputs()]
+    records = []
+    batch_size = 1
+    while batch_size <= args.max_batch_size:
+        inputs = create_batch_inputs(io_ports["inputs"], batch_axes, batch_size, args.dim)
+        input_mb = sum(data.nbytes for data in inputs.values()) / (1024 * 1024)
+        if input_mb > args.max_memory_mb:
+            break
+        reset_peak_rss()
+        try:
+            latencies = benchmark_utils.time_runs(sess, output_names, inputs, args.warmup_iterations,
+                                                  args.iterations)
+        except Exception as e:
+            # e.g. the model only supports batch size 1 despite its symbolic dim, or ORT ran out of memory
+            print("Stop the sweep of {} at batch size {}: {}".format(model.model_path, batch_size, e))
+            break
+        record = {"model_path": model.model_path, "batch_size": batch_size}
+        record.update(benchmark_utils.summarize_latencies(latencies))
+        record["samples_per_sec"] = round(record.pop("throughput_per_sec") * batch_size, 2)
+        record["peak_rss_mb"] = round(get_peak_rss_mb(), 1)
+        print("batch size {}: p50 {} ms, {} samples/s, peak RSS {} MB".format(
+            batch_size, record["p50_ms"], record["samples_per_sec"], record["peak_rss_mb"]))
+        records.append(record)
+        if record["peak_rss_mb"] >= args.max_memory_mb:
+            break
+        batch_size *= 2
+    if records:
+        best = max(records, key=lambda r: r["samples_per_sec"])
+        print("[BEST] {} serves the most samples/s at batch size {}".format(model.model_path, best["batch_size"]))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure ONNX Model Zoo models at growing batch sizes")
+    parser.add_argument("--path", required=False, default=None, type=str, nargs="+",
+                        help="The model paths in the manifest to sweep. Defaults to all models. "
+                             "e.g., vision/classification/resnet/model/resnet50-v1-7.onnx")
+    parser.add_argument("--manifest", required=False, default=MANIFEST_FILE, type=str,
+                        help="The manifest to read the io_ports of the models from")
+    parser.add_argument("--max_batch_size", required=False, default=256, type=int,
+                        help="Largest batch size to measure")
+    parser.add_argument("--max_memory_mb", required=False, default=4096, type=float,
+                        help="Stop the sweep of a model once its peak RSS reaches this many MB")
+    parser.add_argument("--dim", required=False, default={},
+                        type=lambda s: {k: int(v) for k, v in (item.split("=") for item in s.split(","))},
+                        help="Values of symbolic dims other than the batch axis, e.g. --dim seq_len=128. "
+                             "Defaults to 1")
+    parser.add_argument("--session_profile", required=False, default="default", type=str,
+                        help="SessionOptions of the measured sessions",
+                        choices=check_model.SESSION_PROFILES)
+    parser.add_argument("--warmup_iterations", required=False, default=5, type=int,
+                        help="Number of untimed runs per batch size")
+    parser.add_argument("--iterations", required=False, default=20, type=int,
+                        help="Number of timed runs per batch size")
+    parser.add_argument("--output", required=False, default=SWEEP_FILE, type=str,
+                        help="File to append the results to. CSV if it ends with .csv, otherwise JSON lines")
+    parser.add_argument("--drop", required=False, default=False, action="store_true",
+                        help="Drop downloaded models after the sweep. (For space limitation in CIs)")
+    parser.add_argument("--perf_db", required=False, default=None, type=str,
+                        help="SQLite database to also store the results in, to compare them with perf_store.py compare")
+    parser.add_argument("--perf_label", required=False, default=None, type=str,
+                        help="Name of the run in --perf_db, e.g. a CI build number")
+    args = parser.parse_args()
+
+    with open(args.manifest, "r") as f:
+        manifest = json.load(f)
+    if args.path is not None:
+        paths = {path.replace("\\", "/") for path in args.path}
+        manifest = [model for model in manifest if model["model_path"] in paths]
+
+    session_options = check_model.get_session_options(args.session_profile)
+    manifest_shas = result_cache.load_manifest_shas(args.manifest)
+    for model_info in manifest:
+        model_path = model_info["model_path"]
+        io_ports = model_info["metadata"].get("io_ports")
+        if io_ports is None:
+            print("Skip {} because the manifest has no io_ports for it".format(model_path))
+            continue
+        print("==============Sweeping {}==============".format(model_path))
+        test_utils.pull_lfs_file(model_path)
+        try:
+            records = sweep_model(ModelHandle(model_path, session_options=session_options), io_ports, args)
+        except Exception as e:
+            print("[FAIL] {}: {}".format(model_path, e))
+            records = []
+        for record in records:
+            record["session_profile"] = args.session_profile
+        benchmark_utils.write_results(records, args.output)
+        if args.perf_db:
+            perf_store.add_results(records, args.perf_db, args.session_profile, args.perf_label, manifest_shas)
+        if args.drop and os.path.exists(model_path):
+            os.remove(model_path)
+
+
+if __name__ == "__main__":
+    main()
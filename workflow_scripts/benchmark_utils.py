@@ -0,0 +1,125 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BENCHMARK_FILE = "ci_benchmark.jsonl"
+STRESS_FILE = "ci_stress.jsonl"
+PERCENTILES = (50, 90, 99)
+# fields of the records that are only kept in the perf store, see perf_store.py
+RAW_FIELDS = ("latencies_ms",)
+
+
+def time_runs(sess, output_names, inputs, warmup_iterations=5, iterations=20):
+    """
+    Run an InferenceSession repeatedly with the same inputs and measure the wall-clock latency of each run.
+
+    :param sess: onnxruntime.InferenceSession to run.
+    :param output_names: Names of the outputs to fetch.
+    :param inputs: Map of input names to numpy ndarray data.
+    :param warmup_iterations: Number of untimed runs first, e.g. to let ORT allocate its memory arenas.
+    :param iterations: Number of timed runs.
+    :return: numpy array of the latency of each timed run in milliseconds.
+    """
+    for _ in range(warmup_iterations):
+        sess.run(output_names, inputs)
+    latencies = np.empty(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        sess.run(output_names, inputs)
+        latencies[i] = (time.perf_counter() - start) * 1000
+    return latencies
+
+
+def time_concurrent_runs(sess, runs, threads, iterations=20, check_outputs=None):
+    """
+    Run one InferenceSession from several threads at the same time, the way a server shares a session between
+    its request threads, and measure the wall-clock latency of each run.
+
+    :param sess: onnxruntime.InferenceSession shared by all threads.
+    :param runs: List of (output_names, inputs, expected_outputs) to replay. Each thread cycles through them,
+                 starting at a different one.
+    :param threads: Number of threads calling sess.run concurrently.
+    :param iterations: Number of runs per thread.
+    :param check_outputs: Optional function(output_names, expected_outputs, outputs) returning whether the outputs
+                          of a run are within tolerance.
+    :return: tuple(numpy array of the latency of each run in milliseconds, wall-clock seconds of all runs,
+                   number of runs whose outputs did not pass check_outputs)
+    """
+    start_together = threading.Barrier(threads)
+
+    def worker(thread_index):
+        latencies = []
+        mismatches = 0
+        start_together.wait()
+        for i in range(iterations):
+            output_names, inputs, expected_outputs = runs[(thread_index + i) % len(runs)]
+            start = time.perf_counter()
+            outputs = sess.run(output_names, inputs)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if check_outputs is not None and not check_outputs(output_names, expected_outputs, outputs):
+                mismatches += 1
+        return latencies, mismatches
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(worker, range(threads)))
+    wall_seconds = time.perf_counter() - start
+    latencies = np.array([latency for thread_latencies, _ in results for latency in thread_latencies])
+    return latencies, wall_seconds, sum(mismatches for _, mismatches in results)
+
+
+def summarize_latencies(latencies):
+    """Return a map of latency statistics in milliseconds and the throughput in runs per second.
+    The latency of every run is kept in latencies_ms for the significance tests of perf_store."""
+    summary = {"iterations": len(latencies)}
+    if len(latencies) == 0:
+        return summary
+    for percentile, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        summary["p{}_ms".format(percentile)] = round(float(value), 4)
+    summary["mean_ms"] = round(float(latencies.mean()), 4)
+    summary["min_ms"] = round(float(latencies.min()), 4)
+    summary["max_ms"] = round(float(latencies.max()), 4)
+    summary["throughput_per_sec"] = round(1000 * len(latencies) / float(latencies.sum()), 2)
+    summary["latencies_ms"] = np.round(latencies, 4).tolist()
+    return summary
+
+
+def write_results(records, output_path=BENCHMARK_FILE):
+    """
+    Append benchmark records to a results file, one record per model and test_data_set.
+
+    :param records: List of maps of field name to value.
+    :param output_path: A .csv file gets one row per record and a header with the fields of all records when it
+                        is created. Records with fields that are not in the header of an existing .csv file are
+                        refused. Any other file gets one JSON object per line.
+    """
+    records = [{k: v for k, v in record.items() if k not in RAW_FIELDS} for record in records]
+    if not records:
+        return
+    if output_path.endswith(".csv"):
+        fields = list(dict.fromkeys(k for record in records for k in record))
+        new_file = not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+        if not new_file:
+            with open(output_path, "r", newline="") as f:
+                header = next(csv.reader(f), [])
+            missing = [field for field in fields if field not in header]
+            if missing:
+                raise ValueError("{} has no columns for {}. Write these results to another file.".format(
+                    output_path, ", ".join(missing)))
+            fields = header
+        with open(output_path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(output_path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
@@ -0,0 +1,99 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import numpy as np
+
+
+class BoundSession:
+    """
+    Runs an InferenceSession through IOBinding with output buffers that are allocated once and reused by every
+    later run with inputs of the same shapes, the way a server keeps its buffers between requests. sess.run
+    allocates new output arrays on every call instead.
+
+    The output shapes of models with symbolic dims are only known after a run, so the first run with new input
+    shapes is a normal sess.run whose output arrays become the buffers of the later runs. Only outputs whose dims
+    are fixed or named after input dims get a buffer. The shapes of the others, e.g. the outputs of NonZero or
+    NonMaxSuppression, can depend on the input values, so onnxruntime allocates them on every run.
+
+    Has the get_inputs, get_outputs and run of an InferenceSession, so it can be used in its place. The arrays
+    returned by run are overwritten by the next run, and one BoundSession must not be run from several threads.
+    """
+
+    def __init__(self, sess):
+        self.sess = sess
+        # (output names, input names, shapes and dtypes) -> (IOBinding with the outputs bound, output buffers
+        # or None for the outputs onnxruntime allocates), or None if the outputs can't be bound, e.g. sequences
+        self._bindings = {}
+        input_dims = {dim for arg in sess.get_inputs() for dim in arg.shape if isinstance(dim, str)}
+        # the outputs whose shape only depends on the input shapes
+        self._fixed_outputs = {arg.name for arg in sess.get_outputs()
+                               if all(isinstance(dim, int) or dim in input_dims for dim in arg.shape)}
+        self.runs = 0
+        self.bound_runs = 0
+        self.saved_allocations = 0
+        self.allocated_bytes = 0
+        self.reused_bytes = 0
+
+    def get_inputs(self):
+        return self.sess.get_inputs()
+
+    def get_outputs(self):
+        return self.sess.get_outputs()
+
+    def _bind(self, output_names, outputs):
+        if not all(isinstance(output, np.ndarray) and output.dtype.kind in "biufc" for output in outputs):
+            return None
+        binding = self.sess.io_binding()
+        buffers = [np.ascontiguousarray(output) if name in self._fixed_outputs else None
+                   for name, output in zip(output_names, outputs)]
+        for name, buffer in zip(output_names, buffers):
+            if buffer is None:
+                binding.bind_output(name, "cpu")
+            else:
+                binding.bind_output(name, "cpu", 0, buffer.dtype.type, list(buffer.shape), buffer.ctypes.data)
+        return binding, buffers
+
+    def run(self, output_names, inputs, run_options=None):
+        self.runs += 1
+        if not all(isinstance(data, np.ndarray) and data.dtype.kind in "biufc" for data in inputs.values()):
+            return self.sess.run(output_names, inputs, run_options)
+        key = (tuple(output_names), tuple((name, data.shape, data.dtype.str) for name, data in inputs.items()))
+        if key not in self._bindings:
+            outputs = self.sess.run(output_names, inputs, run_options)
+            self._bindings[key] = self._bind(output_names, outputs)
+            if self._bindings[key] is not None:
+                self.allocated_bytes += sum(buffer.nbytes for buffer in self._bindings[key][1] if buffer is not None)
+            return outputs
+        if self._bindings[key] is None:
+            return self.sess.run(output_names, inputs, run_options)
+
+        binding, buffers = self._bindings[key]
+        for name, data in inputs.items():
+            binding.bind_cpu_input(name, np.ascontiguousarray(data))
+        for name, buffer in zip(output_names, buffers):
+            if buffer is None:
+                # bound again on every run, otherwise the output of the last run is reused with its shape
+                binding.bind_output(name, "cpu")
+        self.sess.run_with_iobinding(binding, run_options)
+        self.bound_runs += 1
+        reused = [buffer for buffer in buffers if buffer is not None]
+        self.saved_allocations += len(reused)
+        self.reused_bytes += sum(buffer.nbytes for buffer in reused)
+        if len(reused) == len(buffers):
+            return list(buffers)
+        ort_outputs = binding.get_outputs()
+        return [buffer if buffer is not None else ort_output.numpy()
+                for buffer, ort_output in zip(buffers, ort_outputs)]
+
+    def get_stats(self):
+        """Return how many runs reused their output buffers and how many bytes of output allocations that saved."""
+        return {
+            "io_binding_runs": self.bound_runs,
+            "output_buffer_mb": round(self.allocated_bytes / (1024 * 1024), 4),
+            "allocations_saved": self.saved_allocations,
+            "allocation_mb_saved": round(self.reused_bytes / (1024 * 1024), 4),
+        }
+
+    def format_stats(self):
+        return "IOBinding: {} of {} runs reused {} MB of output buffers, saving {} MB of output allocations".format(
+            self.bound_runs, self.runs, round(self.allocated_bytes / (1024 * 1024), 4),
+            round(self.reused_bytes / (1024 * 1024), 4))
@@ -1,42 +1,126 @@
 # SPDX-License-Identifier: Apache-2.0
 
 from cpuinfo import get_cpu_info
+from model_handle import as_model_handle
 import ort_test_dir_utils
-import onnxruntime
 import onnx
+import onnxruntime
 import os
-from shutil import rmtree
+import platform
+import result_cache
 import tarfile
 import test_utils
 
 
+# CPU features that select different ORT kernels, named like the py-cpuinfo flags without underscores
+CPU_CAPABILITIES = (
+    "avx", "avx2", "fma", "avx512f", "avx512bw", "avx512vnni", "avxvnni", "avx512bf16", "avx512fp16",
+    "amxtile", "amxint8", "amxbf16", "asimd", "asimddp", "i8mm", "sve",
+)
+_cpu_capabilities = None
+
+
+def _probe_cpu_flags():
+    # read /proc/cpuinfo directly where it exists; py-cpuinfo spawns a subprocess and takes seconds
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                # "flags" on x86, "Features" on Arm
+                if line.startswith("flags") or line.startswith("Features"):
+                    return line.split(":", 1)[1].split()
+    return get_cpu_info()["flags"]
+
+
+def get_cpu_capabilities(cache_path=None):
+    """Return the frozenset of CPU_CAPABILITIES supported by this machine. The CPU is only probed once per process.
+    If cache_path is given, the capabilities are read from or saved to that result cache."""
+    global _cpu_capabilities
+    if _cpu_capabilities is None and cache_path is not None:
+        _cpu_capabilities = result_cache.load_cpu_capabilities(cache_path)
+    if _cpu_capabilities is None:
+        flags = {flag.replace("_", "").lower() for flag in _probe_cpu_flags()}
+        _cpu_capabilities = frozenset(c for c in CPU_CAPABILITIES if c in flags)
+        if cache_path is not None:
+            result_cache.save_cpu_capabilities(_cpu_capabilities, cache_path)
+    return _cpu_capabilities
+
+
+def get_cpu_fingerprint():
+    """Return a string that identifies the CPU model and its capabilities, to tell apart performance results from
+    different machines."""
+    return "{}/{}/{}".format(platform.machine(), result_cache.get_cpu_model(),
+                             "+".join(sorted(get_cpu_capabilities())))
+
+
+def set_cpu_capabilities(cpu_capabilities):
+    # reuse capabilities probed by another process, e.g. in the worker processes of test_models
+    global _cpu_capabilities
+    _cpu_capabilities = frozenset(cpu_capabilities)
+
+
 def has_vnni_support():
-    return "avx512vnni" in set(get_cpu_info()["flags"])
+    return "avx512vnni" in get_cpu_capabilities()
+
+
+# SessionOptions used for the ORT checks, selected by test_models --session_profile
+#   default: ORT defaults (all graph optimizations, one intra-op thread per physical core)
+#   fast-verify: basic graph optimizations only and a bounded thread count, for the CI where the session creation
+#                of large models dominates and the test data is small
+#   full: all graph optimizations, sequential execution with inter-op threads bounded like fast-verify
+SESSION_PROFILES = ("default", "fast-verify", "full")
 
 
-def run_onnx_checker(model_path):
-    model = onnx.load(model_path)
-    onnx.checker.check_model(model)
+def get_session_options(profile="default", jobs=1):
+    """Return the onnxruntime.SessionOptions of a session profile, or None for the ORT defaults.
+    The thread count of bounded profiles is split between the jobs that run concurrently."""
+    if profile not in SESSION_PROFILES:
+        raise ValueError(f"Unknown session profile {profile}. Choose from {SESSION_PROFILES}")
+    if profile == "default":
+        return None
+    threads = max(1, min(4, (os.cpu_count() or 1) // max(jobs, 1)))
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    if profile == "fast-verify":
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC
+    else:
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return options
+
 
+def run_onnx_checker(model, full_check=False):
+    # model is a model path or a ModelHandle.
+    # Check by path (or the streamed bytes) instead of a ModelProto: onnx then reads the model in C++ without
+    # copying it into Python and serializing it again, and doesn't load external data, so models above the 2GB
+    # protobuf limit can be checked as well. full_check additionally runs strict shape inference.
+    model = as_model_handle(model)
+    onnx.checker.check_model(model.model_path if model.on_disk else model.model_bytes, full_check=full_check)
 
-def ort_skip_reason(model_path):
+
+def ort_skip_reason(model):
+    model = as_model_handle(model)
+    model_path = model.model_path
     if (model_path.endswith("-int8.onnx") or model_path.endswith("-qdq.onnx")) and not has_vnni_support():
         # At least run InferenceSession to test shape inference
-        onnxruntime.InferenceSession(model_path)
+        model.session
         return f"Skip ORT test for {model_path} because this machine lacks avx512vnni support and the output.pb was produced with avx512vnni support."
-    model = onnx.load(model_path)
-    if model.opset_import[0].version < 7:
+    if model.opset_version < 7:
         return f"Skip ORT test for {model_path} because ORT only supports opset version >= 7"
     return None
 
 
-def make_tarfile(output_filename, source_dir):
+def make_tarfile(output_filename, source_dir, arcname=None):
     with tarfile.open(output_filename, "w:gz", format=tarfile.GNU_FORMAT) as tar:
-        tar.add(source_dir, arcname=os.path.basename(source_dir))
+        tar.add(source_dir, arcname=arcname or os.path.basename(source_dir))
 
 
-def run_backend_ort(model_path, test_data_set=None, tar_gz_path=None):
-    skip_reason = ort_skip_reason(model_path)
+def run_backend_ort(model, test_data_set=None, tar_gz_path=None, workspace=None, data_format="pb", tolerances=None,
+                    stack_batches=False, io_binding=False):
+    # model is a model path or a ModelHandle
+    model = as_model_handle(model)
+    model_path = model.model_path
+    skip_reason = ort_skip_reason(model)
     if skip_reason:
         print(skip_reason)
         return
@@ -47,22 +131,66 @@ def run_backend_ort(model_path, test_data_set=None, tar_gz_path=None):
         # based on the build flags) when instantiating InferenceSession.
         # For example, if NVIDIA GPU is available and ORT Python package is built with CUDA, then call API as following:
         # onnxruntime.InferenceSession(path/to/model, providers=["CUDAExecutionProvider"])
-        onnxruntime.InferenceSession(model_path)
+        model.session
         # Get model name without .onnx
         model_name = os.path.basename(os.path.splitext(model_path)[0])
         if model_name is None:
             print(f"The model path {model_path} is invalid")
             return
-        ort_test_dir_utils.create_test_dir(model_path, "./", test_utils.TEST_ORT_DIR)
-        ort_test_dir_utils.run_test_dir(test_utils.TEST_ORT_DIR)
-        if os.path.exists(model_name) and os.path.isdir(model_name):
-            rmtree(model_name)
-        os.rename(test_utils.TEST_ORT_DIR, model_name)
-        make_tarfile(tar_gz_path, model_name)
-        rmtree(model_name)
+        ort_dir = test_utils.get_ort_dir(workspace)
+        ort_test_dir_utils.create_test_dir(model_path, workspace or "./", test_utils.TEST_ORT_DIR, model=model,
+                                         data_format=data_format, io_binding=io_binding)
+        ort_test_dir_utils.run_test_dir(ort_dir, model=model, tolerances=tolerances, io_binding=io_binding)
+        make_tarfile(tar_gz_path, ort_dir, arcname=model_name)
     # otherwise use the existing "test_data_set_N" as test data
     else:
         test_dir_from_tar = test_utils.get_model_directory(model_path)
-        ort_test_dir_utils.run_test_dir(test_dir_from_tar)
+        ort_test_dir_utils.run_test_dir(test_dir_from_tar, model=model, tolerances=tolerances,
+                                        stack_batches=stack_batches, io_binding=io_binding)
     # remove the produced test_dir from ORT
-    test_utils.remove_onnxruntime_test_dir()
+    test_utils.remove_onnxruntime_test_dir(workspace)
+
+
+def run_backend_ort_on_test_data(model, test_data_sets, tolerances=None, stack_batches=False, io_binding=False):
+    # check a model with test data streamed out of a .tar.gz by test_utils.stream_test_data
+    skip_reason = ort_skip_reason(model)
+    if skip_reason:
+        print(skip_reason)
+        return
+    if not test_data_sets:
+        raise ValueError(f"No test_data_set_N was found for {model.model_path}")
+    ort_test_dir_utils.run_test_data(model, test_data_sets, tolerances, stack_batches, io_binding)
+
+
+def run_benchmark_ort(model, test_data_sets=None, warmup_iterations=5, iterations=20, io_binding=False):
+    """Return the latency and throughput of a checked model for each of its test_data_set, measured with the inputs
+    of test_data_sets streamed out of a .tar.gz or, if not given, of the test_data_set_N next to the model."""
+    if ort_skip_reason(model):
+        return []
+    if test_data_sets is not None:
+        records = ort_test_dir_utils.benchmark_test_data(model, test_data_sets, warmup_iterations, iterations,
+                                                         io_binding)
+    else:
+        test_dir_from_tar = test_utils.get_model_directory(model.model_path)
+        records = ort_test_dir_utils.benchmark_test_dir(test_dir_from_tar, model, warmup_iterations, iterations,
+                                                        io_binding)
+    for record in records:
+        record["onnxruntime_version"] = onnxruntime.__version__
+    return records
+
+
+def run_stress_test_ort(model, test_data_sets=None, thread_counts=(1, 2, 4, 8), iterations=20, tolerances=None):
+    """Replay the test data of a checked model from several threads against its one InferenceSession and return
+    the throughput and latency for each thread count. Raises if any concurrent run gives a mismatching output."""
+    if ort_skip_reason(model):
+        return []
+    if test_data_sets is not None:
+        records = ort_test_dir_utils.stress_test_data(model, test_data_sets, thread_counts, iterations,
+                                                        tolerances)
+    else:
+        test_dir_from_tar = test_utils.get_model_directory(model.model_path)
+        records = ort_test_dir_utils.stress_test_dir(test_dir_from_tar, model, thread_counts, iterations,
+                                                       tolerances)
+    for record in records:
+        record["onnxruntime_version"] = onnxruntime.__version__
+    return records
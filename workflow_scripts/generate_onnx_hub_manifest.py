@@ -1,9 +1,9 @@
 # SPDX-License-Identifier: Apache-2.0
 
-import hashlib
 import json
 import os
 import re
+from concurrent.futures import Future, ThreadPoolExecutor
 import bs4
 import markdown
 import pandas as pd
@@ -14,8 +14,10 @@ from onnxruntime.capi.onnxruntime_pybind11_state import NotImplemented
 import onnx
 from onnx import shape_inference
 import argparse
+from model_ports import get_io_ports, load_model_without_weights
+from result_cache import hash_file
 from test_models import get_changed_models
-from test_utils import pull_lfs_file
+from test_utils import pull_lfs_files, read_lfs_pointers
 
 
 # Acknowledgments to pytablereader codebase for this function
@@ -101,26 +103,39 @@ renamed = df.rename(columns={col: prep_name(col) for col in df.columns.values})
 metadata_fields = [f for f in renamed.columns.values if f not in top_level_fields]
 
 
-def get_file_info(row, field, target_models=None):
+def get_file_info(row, field, target_models=None, lfs_pointers=None):
     source_dir = split(row["source_file"])[0]
     model_file = row[field].contents[0].attrs["href"]
     # So that model relative path is consistent across OS
     rel_path = "/".join(join(source_dir, model_file).split(os.sep))
     if target_models is not None and rel_path not in target_models:
         return None
+    if lfs_pointers is not None and rel_path in lfs_pointers:
+        # the sha256 and size of the payload are in its git-lfs pointer, so it does not need to be downloaded
+        sha256, bytes = lfs_pointers[rel_path]
+        return {
+            field: rel_path,
+            field.replace("_path", "") + "_sha": sha256,
+            field.replace("_path", "") + "_bytes": bytes,
+        }
     # git-lfs pull if target .onnx or .tar.gz does not exist
-    pull_lfs_file(rel_path)
-    pull_lfs_file(rel_path.replace(".onnx", ".tar.gz"))
-    with open(rel_path, "rb") as f:
-        bytes = f.read()
-        sha256 = hashlib.sha256(bytes).hexdigest()
+    pull_lfs_files(sorted({rel_path, rel_path.replace(".onnx", ".tar.gz")}))
+    bytes = os.path.getsize(rel_path)
     return {
         field: rel_path,
-        field.replace("_path", "") + "_sha": sha256,
-        field.replace("_path", "") + "_bytes": len(bytes),
+        # hashed in chunks by the thread pool while the next models are processed, see resolve_file_info
+        field.replace("_path", "") + "_sha": hash_executor.submit(hash_file, rel_path),
+        field.replace("_path", "") + "_bytes": bytes,
     }
 
 
+def resolve_file_info(metadata):
+    # wait for the hashes that get_file_info started
+    for k, v in metadata.items():
+        if isinstance(v, Future):
+            metadata[k] = v.result()
+
+
 def get_model_tags(row):
     source_dir = split(row["source_file"])[0]
     raw_tags = source_dir.split("/")
@@ -134,26 +149,34 @@ def get_model_tags(row):
 def get_model_ports(source_file, metadata, model_name):
     model_path = source_file
     try:
-        # Hide graph warnings. Severity 3 means error and above.
-        ort.set_default_logger_severity(3)
-        # Start from ORT 1.10, ORT requires explicitly setting the providers parameter
-        # if you want to use execution providers
-        # other than the default CPU provider (as opposed to the previous behavior of
-        # providers getting set/registered by default
-        # based on the build flags) when instantiating InferenceSession.
-        # For example, if NVIDIA GPU is available and ORT Python package is built with CUDA, then call API as following:
-        # ort.InferenceSession(path/to/model, providers=['CUDAExecutionProvider'])
-        session = ort.InferenceSession(model_path)
-        inputs = session.get_inputs()
-        outputs = session.get_outputs()
-        io_ports = {
-            "inputs": [{"name": input.name, "shape": input.shape, "type": input.type} for input in inputs],
-            "outputs": [{"name": output.name, "shape": output.shape, "type": output.type} for output in outputs],
-        }
+        # read the ports from the graph without the weights and without creating an InferenceSession
+        try:
+            model = load_model_without_weights(model_path)
+            io_ports = get_io_ports(model)
+        except Exception:
+            # e.g. a git-lfs pointer instead of the model payload, which onnxruntime reports below
+            model, io_ports = None, None
+        if io_ports is None:
+            # Hide graph warnings. Severity 3 means error and above.
+            ort.set_default_logger_severity(3)
+            # Start from ORT 1.10, ORT requires explicitly setting the providers parameter
+            # if you want to use execution providers
+            # other than the default CPU provider (as opposed to the previous behavior of
+            # providers getting set/registered by default
+            # based on the build flags) when instantiating InferenceSession.
+            # For example, if NVIDIA GPU is available and ORT Python package is built with CUDA, then call API as following:
+            # ort.InferenceSession(path/to/model, providers=['CUDAExecutionProvider'])
+            session = ort.InferenceSession(model_path)
+            inputs = session.get_inputs()
+            outputs = session.get_outputs()
+            io_ports = {
+                "inputs": [{"name": input.name, "shape": input.shape, "type": input.type} for input in inputs],
+                "outputs": [{"name": output.name, "shape": output.shape, "type": output.type} for output in outputs],
+            }
 
         extra_ports = None
         if "classification" in metadata["tags"]:
-            inferred_model = shape_inference.infer_shapes(onnx.load(model_path))
+            inferred_model = shape_inference.infer_shapes(model if model is not None else onnx.load(model_path))
             nodes = list(inferred_model.graph.value_info)
             if model_name in feature_tensor_names:
                 node_name = feature_tensor_names[model_name]
@@ -223,7 +246,14 @@ parser.add_argument("--path", required=False, default=None, type=str,
                     help="The model path which you want to update. e.g., vision/classification/resnet/model/resnet50.onnx")
 parser.add_argument("--drop", required=False, default=False, action="store_true",
                     help="Drop downloaded models after verification. (For space limitation in CIs)")
+parser.add_argument("--jobs", required=False, default=os.cpu_count(), type=int,
+                    help="Number of model files hashed in parallel")
+parser.add_argument("--lfs_pointers", required=False, default=False, action="store_true",
+                    help="Read the sha and size of the models from their git-lfs pointers in the git index instead of "
+                         "downloading and hashing them. Only models whose io_ports need recomputing are downloaded")
 args = parser.parse_args()
+# hashlib releases the GIL while hashing the 1 MB chunks of hash_file, so the files are hashed on all cores
+hash_executor = ThreadPoolExecutor(max_workers=args.jobs)
 
 
 output = []
@@ -243,6 +273,15 @@ if args.target == "diff" or args.target == "single":
     for model in output:
         path_to_object[model["model_path"]] = model
 
+lfs_pointers = None
+previous_models = {}
+if args.lfs_pointers:
+    lfs_pointers = read_lfs_pointers()
+    print(f"Read {len(lfs_pointers)} git-lfs pointers")
+    if os.path.exists("ONNX_HUB_MANIFEST.json"):
+        with open("ONNX_HUB_MANIFEST.json", "r") as f:
+            previous_models = {model["model_path"]: model for model in json.load(f)}
+
 for i, row in renamed.iterrows():
     if len(row["model"].contents) > 0 and len(row["model_path"].contents) > 0:
         model_name = row["model"].contents[0]
@@ -253,20 +292,27 @@ for i, row in renamed.iterrows():
             if args.path is None:
                 raise ValueError("Please specify --path if you want to update by single model.")
             target_models = set([args.path.replace("\\", "/")])
-        model_info = get_file_info(row, "model_path", target_models)
+        model_info = get_file_info(row, "model_path", target_models, lfs_pointers)
         if model_info is None:
             continue
         model_path = model_info.pop("model_path")
         metadata = model_info
         metadata["tags"] = get_model_tags(row)
-        io_ports, extra_ports = get_model_ports(model_path, metadata, model_name)
+        previous = previous_models.get(model_path, {}).get("metadata", {})
+        if "io_ports" in previous and previous.get("model_sha") == metadata["model_sha"]:
+            # the model did not change since the previous manifest, so neither did its ports
+            io_ports, extra_ports = previous["io_ports"], previous.get("extra_ports")
+        else:
+            if lfs_pointers is not None:
+                pull_lfs_files([model_path])
+            io_ports, extra_ports = get_model_ports(model_path, metadata, model_name)
         if io_ports is not None:
             metadata["io_ports"] = io_ports
         if extra_ports is not None:
             metadata["extra_ports"] = extra_ports
 
         try:
-            for k, v in get_file_info(row, "model_with_data_path").items():
+            for k, v in get_file_info(row, "model_with_data_path", lfs_pointers=lfs_pointers).items():
                 metadata[k] = v
         except (AttributeError, FileNotFoundError) as e:
             print(f"no model_with_data in file {row['source_file']}: {e}")
@@ -291,6 +337,8 @@ for i, row in renamed.iterrows():
             }
         )
         if args.drop:
+            # the files must be hashed before they are removed
+            resolve_file_info(metadata)
             if os.path.exists(model_path):
                 os.remove(model_path)
             tar_path = model_path.replace(".onnx", ".tar.gz")
@@ -299,6 +347,9 @@ for i, row in renamed.iterrows():
 
     else:
         print("Missing model in {}".format(row["source_file"]))
+for model in output:
+    resolve_file_info(model["metadata"])
+hash_executor.shutdown()
 output.sort(key=lambda x: x["model_path"])
 
 with open("ONNX_HUB_MANIFEST.json", "w+") as f:
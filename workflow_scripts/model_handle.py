@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import time
+
+from bound_session import BoundSession
+import model_ports
+import onnx
+
+import onnxruntime
+
+
+class ModelHandle:
+    """
+    An ONNX model shared by the ORT skip check, test data creation and the test runs, together with one
+    InferenceSession of it. The ModelProto is only parsed when first used, and without the data of its large
+    initializers: only the graph, opset and initializer names are needed for these checks. The weights of a model
+    on disk are never held in Python; ORT reads them from the file.
+    """
+
+    def __init__(self, model_path, model_bytes=None, session_options=None):
+        """
+        :param model_path: Path to the onnx model file. If model_bytes is provided, this is only used as the model
+                           name, e.g. the file name of a model streamed out of a .tar.gz.
+        :param model_bytes: Optional serialized model that is already in memory.
+        :param session_options: Optional onnxruntime.SessionOptions for the shared InferenceSession.
+        """
+        self.model_path = model_path
+        self.on_disk = model_bytes is None
+        self.session_options = session_options
+        self._model_bytes = model_bytes
+        self._proto = None
+        self._session = None
+        self._bound_session = None
+        self.session_seconds = None
+
+    @property
+    def model_bytes(self):
+        # only set for models that are already in memory, e.g. streamed out of a .tar.gz
+        return self._model_bytes
+
+    @property
+    def proto(self):
+        if self._proto is None:
+            if self.on_disk:
+                self._proto = model_ports.load_model_without_weights(self.model_path)
+            else:
+                self._proto = onnx.load_model_from_string(model_ports.strip_initializer_data(self._model_bytes))
+        return self._proto
+
+    @property
+    def opset_version(self):
+        return self.proto.opset_import[0].version
+
+    @property
+    def initializer_names(self):
+        return {initializer.name for initializer in self.proto.graph.initializer}
+
+    @property
+    def session(self):
+        # one InferenceSession shared by the ORT skip check, test data creation and the test runs
+        if self._session is None:
+            start = time.perf_counter()
+            self._session = self.create_session(sess_options=self.session_options)
+            self.session_seconds = time.perf_counter() - start
+        return self._session
+
+    @property
+    def bound_session(self):
+        # the shared InferenceSession run through IOBinding, with output buffers reused by all test_data_sets
+        if self._bound_session is None:
+            self._bound_session = BoundSession(self.session)
+        return self._bound_session
+
+    def create_session(self, **kwargs):
+        # let ORT read a model on disk by itself, which also finds external data next to the model file
+        if self.on_disk:
+            return onnxruntime.InferenceSession(self.model_path, **kwargs)
+        return onnxruntime.InferenceSession(self.model_bytes, **kwargs)
+
+
+def as_model_handle(model):
+    """Return model if it is a ModelHandle already, otherwise a ModelHandle for the model path."""
+    return model if isinstance(model, ModelHandle) else ModelHandle(model)
@@ -0,0 +1,138 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import mmap
+
+import onnx
+from onnx import shape_inference
+from onnx_test_data_utils import TENSOR_DATA_FIELDS, read_varint
+
+# ModelProto.graph and GraphProto.initializer, see onnx/onnx.proto
+_MODEL_GRAPH_FIELD = 7
+_GRAPH_INITIALIZER_FIELD = 5
+# initializers up to this size keep their data, e.g. the shape input of a Reshape that shape inference reads
+SMALL_INITIALIZER_BYTES = 1024
+
+
+def _encode_varint(value):
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return encoded
+
+
+def _iterate_fields(buffer, start, end):
+    # (field number, wire type, start of the field, start of its value, end of the field) of a serialized message
+    pos = start
+    while pos < end:
+        field_start = pos
+        key, pos = read_varint(buffer, pos)
+        field, wire_type = key >> 3, key & 0x7
+        value_start = pos
+        if wire_type == 0:
+            _, pos = read_varint(buffer, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, value_start = read_varint(buffer, pos)
+            pos = value_start + length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}.".format(wire_type))
+        if pos > end:
+            raise ValueError("Truncated protobuf message.")
+        yield field, wire_type, field_start, value_start, pos
+
+
+def _length_delimited(field, data):
+    return _encode_varint(field << 3 | 2) + _encode_varint(len(data)) + data
+
+
+def _strip_graph(buffer, start, end, max_bytes):
+    graph = bytearray()
+    for field, wire_type, field_start, value_start, field_end in _iterate_fields(buffer, start, end):
+        if field == _GRAPH_INITIALIZER_FIELD and wire_type == 2 and field_end - value_start > max_bytes:
+            # keep the name, dims and data type of the initializer
+            tensor = bytearray()
+            for tensor_field, _, tensor_field_start, _, tensor_field_end in _iterate_fields(
+                    buffer, value_start, field_end):
+                if tensor_field not in TENSOR_DATA_FIELDS:
+                    tensor += buffer[tensor_field_start:tensor_field_end]
+            graph += _length_delimited(field, tensor)
+        else:
+            graph += buffer[field_start:field_end]
+    return graph
+
+
+def strip_initializer_data(buffer, max_bytes=SMALL_INITIALIZER_BYTES):
+    """Return a serialized ModelProto without the data of the initializers of its main graph that are larger than
+    max_bytes, skipping that data in the protobuf wire format instead of parsing it."""
+    model = bytearray()
+    for field, wire_type, field_start, value_start, field_end in _iterate_fields(buffer, 0, len(buffer)):
+        if field == _MODEL_GRAPH_FIELD and wire_type == 2:
+            model += _length_delimited(field, _strip_graph(buffer, value_start, field_end, max_bytes))
+        else:
+            model += buffer[field_start:field_end]
+    return bytes(model)
+
+
+def load_model_without_weights(model_path, max_bytes=SMALL_INITIALIZER_BYTES):
+    """Load the ModelProto of a model file without the data of its large initializers. The file is memory mapped,
+    so the weights are never read into memory. External data is not loaded either."""
+    with open(model_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return onnx.load_model_from_string(strip_initializer_data(buffer, max_bytes))
+
+
+def _format_type(type_proto):
+    # the type names of onnxruntime, e.g. tensor(float)
+    return "tensor({})".format(onnx.TensorProto.DataType.Name(type_proto.tensor_type.elem_type).lower())
+
+
+def _get_dim_params(graph):
+    dim_params = set()
+    for value_info in list(graph.input) + list(graph.output) + list(graph.value_info):
+        if value_info.type.WhichOneof("value") == "tensor_type":
+            dim_params.update(dim.dim_param for dim in value_info.type.tensor_type.shape.dim if dim.dim_param)
+    return dim_params
+
+
+def _format_shape(type_proto):
+    # the shapes of onnxruntime: dim_param as str, dim_value as int, unknown dims as None
+    shape = []
+    for dim in type_proto.tensor_type.shape.dim:
+        dim_type = dim.WhichOneof("value")
+        shape.append(dim.dim_value if dim_type == "dim_value" else dim.dim_param if dim_type == "dim_param" else None)
+    return shape
+
+
+def get_io_ports(model):
+    """
+    Return the inputs and outputs of a model like onnxruntime reports them, from its graph only.
+
+    :param model: ModelProto, e.g. from load_model_without_weights. Shape inference is run on it for the outputs.
+    :return: Map of "inputs" and "outputs" to lists of {"name", "shape", "type"}. Initializers are not inputs.
+             None if a port is not a tensor or an output shape is not fully inferred; onnxruntime is needed for
+             those. Shape inference names the dims it does not know, e.g. unk__0, where onnxruntime may report
+             None or, from constant inputs, a value.
+    """
+    dim_params = _get_dim_params(model.graph)
+    inferred_model = shape_inference.infer_shapes(model)
+    initializer_names = {initializer.name for initializer in inferred_model.graph.initializer}
+    inputs = [i for i in inferred_model.graph.input if i.name not in initializer_names]
+    outputs = list(inferred_model.graph.output)
+    for port in inputs + outputs:
+        if port.type.WhichOneof("value") != "tensor_type" or not port.type.tensor_type.elem_type:
+            return None
+    if not all(output.type.tensor_type.HasField("shape") for output in outputs):
+        return None
+    for output in outputs:
+        for dim in output.type.tensor_type.shape.dim:
+            if not dim.HasField("dim_value") and dim.dim_param not in dim_params:
+                return None
+    return {
+        "inputs": [{"name": i.name, "shape": _format_shape(i.type), "type": _format_type(i.type)} for i in inputs],
+        "outputs": [{"name": o.name, "shape": _format_shape(o.type), "type": _format_type(o.type)} for o in outputs],
+    }
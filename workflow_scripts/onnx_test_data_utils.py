@@ -5,8 +5,12 @@
 
 import argparse
 import glob
+import json
+import mmap
 import os
+import struct
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import onnx
@@ -20,6 +24,137 @@ def read_tensorproto_pb_file(filename):
     np_array = numpy_helper.to_array(tensor)
     return tensor.name, np_array
 
+# TensorProto.data_type values whose raw_data can be viewed as a numpy array as is
+_RAW_DATA_NP_TYPES = {
+    onnx.TensorProto.FLOAT: np.dtype("<f4"),
+    onnx.TensorProto.UINT8: np.dtype("u1"),
+    onnx.TensorProto.INT8: np.dtype("i1"),
+    onnx.TensorProto.UINT16: np.dtype("<u2"),
+    onnx.TensorProto.INT16: np.dtype("<i2"),
+    onnx.TensorProto.INT32: np.dtype("<i4"),
+    onnx.TensorProto.INT64: np.dtype("<i8"),
+    onnx.TensorProto.BOOL: np.dtype("?"),
+    onnx.TensorProto.FLOAT16: np.dtype("<f2"),
+    onnx.TensorProto.DOUBLE: np.dtype("<f8"),
+    onnx.TensorProto.UINT32: np.dtype("<u4"),
+    onnx.TensorProto.UINT64: np.dtype("<u8"),
+    onnx.TensorProto.COMPLEX64: np.dtype("<c8"),
+    onnx.TensorProto.COMPLEX128: np.dtype("<c16"),
+}
+# TensorProto field numbers, see onnx/onnx.proto
+_DIMS_FIELD = 1
+_DATA_TYPE_FIELD = 2
+_NAME_FIELD = 8
+_RAW_DATA_FIELD = 9
+_EXTERNAL_DATA_FIELD = 13
+_DATA_LOCATION_FIELD = 14
+# fields that hold the tensor data: float/int32/string/int64_data, raw_data and double/uint64_data
+TENSOR_DATA_FIELDS = {4, 5, 6, 7, _RAW_DATA_FIELD, 10, 11}
+# fields that can hold the tensor data instead of raw_data, including external_data
+_TYPED_DATA_FIELDS = (TENSOR_DATA_FIELDS - {_RAW_DATA_FIELD}) | {_EXTERNAL_DATA_FIELD}
+
+
+def read_varint(buffer, pos):
+    """Read a protobuf varint from buffer at pos. Returns tuple(value, position after the varint)."""
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _parse_raw_tensorproto(buffer):
+    """Walk the protobuf wire format of a serialized TensorProto and return (name, dims, data_type, offset, length)
+    of its raw_data in buffer, or None if the tensor data is not stored in raw_data."""
+    name = ""
+    dims = []
+    data_type = None
+    raw_data = None
+    pos = 0
+    end = len(buffer)
+    while pos < end:
+        key, pos = read_varint(buffer, pos)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = read_varint(buffer, pos)
+            if field == _DIMS_FIELD:
+                # int64, negative values are not valid dims
+                dims.append(value)
+            elif field == _DATA_TYPE_FIELD:
+                data_type = value
+            elif field == _DATA_LOCATION_FIELD and value != onnx.TensorProto.DEFAULT:
+                return None
+        elif wire_type == 2:
+            length, pos = read_varint(buffer, pos)
+            if pos + length > end:
+                raise ValueError("Truncated TensorProto.")
+            if field == _DIMS_FIELD:
+                # packed dims
+                packed_end = pos + length
+                while pos < packed_end:
+                    value, pos = read_varint(buffer, pos)
+                    dims.append(value)
+                continue
+            if field == _NAME_FIELD:
+                name = bytes(buffer[pos:pos + length]).decode("utf-8")
+            elif field == _RAW_DATA_FIELD:
+                raw_data = (pos, length)
+            elif field in _TYPED_DATA_FIELDS and length > 0:
+                return None
+            pos += length
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        else:
+            # groups are not used by TensorProto
+            return None
+        if field in _TYPED_DATA_FIELDS and wire_type != 2:
+            return None
+
+    if data_type not in _RAW_DATA_NP_TYPES:
+        return None
+    if raw_data is None:
+        if int(np.prod(dims)) != 0:
+            return None
+        raw_data = (0, 0)
+    return name, dims, data_type, raw_data[0], raw_data[1]
+
+
+def read_tensorproto_pb_file_mmap(filename):
+    """Return tuple of tensor name and a read-only numpy.ndarray view of the raw_data in a memory mapped pb file
+    containing a TensorProto, without parsing or copying the data. Return None if the tensor data is not stored
+    in raw_data, e.g. for string tensors; use read_tensorproto_pb_file for those."""
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        # the array keeps the mapping alive after the file is closed
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with memoryview(buffer) as view:
+        parsed = _parse_raw_tensorproto(view)
+    if parsed is None:
+        buffer.close()
+        return None
+    name, dims, data_type, offset, length = parsed
+    np_type = _RAW_DATA_NP_TYPES[data_type]
+    count = int(np.prod(dims))
+    if count * np_type.itemsize != length:
+        raise ValueError("raw_data of {} has {} bytes, expected {}.".format(filename, length, count * np_type.itemsize))
+    np_array = np.frombuffer(buffer, dtype=np_type, count=count, offset=offset).reshape(dims)
+    return name, np_array
+
+
+def read_tensorproto_pb_bytes(data):
+    """Return tuple of tensor name and numpy.ndarray of the data from the serialized bytes of a TensorProto."""
+    tensor = onnx.TensorProto()
+    tensor.ParseFromString(data)
+    np_array = numpy_helper.to_array(tensor)
+    return tensor.name, np_array
+
 def read_sequenceproto_pb_file(filename):
     """Return tuple of sequence name and list of numpy.ndarray of the data from a pb file containing a SequenceProto."""
     seq = SequenceProto()
@@ -28,6 +163,128 @@ def read_sequenceproto_pb_file(filename):
     list_of_arrays = numpy_helper.to_list(seq)
     return seq.name, list_of_arrays
 
+def read_sequenceproto_pb_bytes(data):
+    """Return tuple of sequence name and list of numpy.ndarray of the data from the serialized bytes of a SequenceProto."""
+    seq = SequenceProto()
+    seq.ParseFromString(data)
+    list_of_arrays = numpy_helper.to_list(seq)
+    return seq.name, list_of_arrays
+
+
+# Uncompressed container with all tensors of a test_data_set, an alternative to the input_N.pb/output_N.pb files.
+# Layout: magic, little-endian uint64 header length, JSON header, tensor data.
+# The header lists for every tensor its kind (input/output), index, name, numpy dtype str, shape and the offset of
+# its data from the start of the file. The data of every tensor is aligned to TEST_DATA_ALIGNMENT bytes so that
+# it can be used in place from a memory mapped file.
+TEST_DATA_CONTAINER_FILE = "test_data.npt"
+TEST_DATA_CONTAINER_MAGIC = b"ONNXTD01"
+TEST_DATA_ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + TEST_DATA_ALIGNMENT - 1) // TEST_DATA_ALIGNMENT * TEST_DATA_ALIGNMENT
+
+
+def save_test_data_container(filename, inputs, outputs):
+    """
+    Save the inputs and outputs of a test_data_set into one test data container file.
+
+    :param filename: File to write.
+    :param inputs: List of tuple(name, numpy.ndarray) of the inputs, in the order of the model inputs.
+    :param outputs: List of tuple(name, numpy.ndarray) of the expected outputs, in the order of the model outputs.
+    """
+    tensors = []
+    arrays = []
+    for kind, name_data_list in [("input", inputs), ("output", outputs)]:
+        for index, (name, data) in enumerate(name_data_list):
+            data = np.asarray(data)
+            if data.dtype.hasobject:
+                raise ValueError("{} of type {} can not be stored in a test data container.".format(name, data.dtype))
+            # not np.ascontiguousarray, which turns scalars into 1-d arrays
+            data = np.asarray(data, dtype=data.dtype.newbyteorder("<"), order="C")
+            tensors.append({"kind": kind, "index": index, "name": name, "dtype": data.dtype.str,
+                            "shape": list(data.shape), "nbytes": data.nbytes})
+            arrays.append(data)
+
+    # the header size depends on the offsets in it, so reserve room for them before computing them
+    header_size = len(json.dumps({"tensors": [dict(t, offset=2 ** 63) for t in tensors]}).encode("utf-8"))
+    offset = _align(len(TEST_DATA_CONTAINER_MAGIC) + 8 + header_size)
+    for tensor in tensors:
+        tensor["offset"] = offset
+        offset = _align(offset + tensor["nbytes"])
+    header = json.dumps({"tensors": tensors}).encode("utf-8").ljust(header_size)
+
+    with open(filename, "wb") as f:
+        f.write(TEST_DATA_CONTAINER_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for tensor, data in zip(tensors, arrays):
+            f.write(b"\0" * (tensor["offset"] - f.tell()))
+            f.write(data.tobytes())
+
+
+def load_test_data_container(filename_or_buffer):
+    """
+    Load a test data container without copying the tensor data.
+
+    :param filename_or_buffer: Path of a container file, which is memory mapped, or the bytes of one.
+    :return: tuple(dictionary of input name to numpy.ndarray of data,
+                   dictionary of output name to numpy.ndarray). The arrays are read-only views of the file or buffer.
+    """
+    if isinstance(filename_or_buffer, (bytes, bytearray, memoryview)):
+        buffer = filename_or_buffer
+    else:
+        with open(filename_or_buffer, "rb") as f:
+            # the arrays keep the mapping alive after the file is closed
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic_size = len(TEST_DATA_CONTAINER_MAGIC)
+    if bytes(buffer[:magic_size]) != TEST_DATA_CONTAINER_MAGIC:
+        raise ValueError("Not a test data container.")
+    (header_size,) = struct.unpack("<Q", buffer[magic_size:magic_size + 8])
+    header = json.loads(bytes(buffer[magic_size + 8:magic_size + 8 + header_size]).decode("utf-8"))
+
+    inputs = {}
+    outputs = {}
+    for tensor in sorted(header["tensors"], key=lambda t: (t["kind"], t["index"])):
+        dtype = np.dtype(tensor["dtype"])
+        count = int(np.prod(tensor["shape"]))
+        data = np.frombuffer(buffer, dtype=dtype, count=count, offset=tensor["offset"]).reshape(tensor["shape"])
+        (inputs if tensor["kind"] == "input" else outputs)[tensor["name"]] = data
+    return inputs, outputs
+
+
+def pb_dir_to_container(dir_name, remove_pb=False):
+    """
+    Convert the input_N.pb and output_N.pb files of a test_data_set directory into a test data container in the
+    same directory. Sequences are not supported by the container; directories with them are left as they are.
+
+    :param dir_name: test_data_set directory.
+    :param remove_pb: Remove the .pb files after the conversion.
+    :return: Path of the container, or None if the directory was not converted.
+    """
+    name_data_lists = {}
+    pb_files = []
+    for prefix in ["input", "output"]:
+        filenames = glob.glob(os.path.join(dir_name, "{}_*.pb".format(prefix)))
+        filenames.sort(key=lambda f: int(os.path.splitext(f)[0].split("_")[-1]))
+        name_data_lists[prefix] = []
+        for filename in filenames:
+            try:
+                name_data_lists[prefix].append(read_tensorproto_pb_file(filename))
+            except Exception:
+                print("Skip {} because {} is not a TensorProto.".format(dir_name, filename))
+                return None
+        pb_files += filenames
+    if not pb_files:
+        return None
+
+    container = os.path.join(dir_name, TEST_DATA_CONTAINER_FILE)
+    save_test_data_container(container, name_data_lists["input"], name_data_lists["output"])
+    if remove_pb:
+        for filename in pb_files:
+            os.remove(filename)
+    return container
+
 
 def dump_tensorproto_pb_file(filename):
     """Dump the data from a pb file containing a TensorProto."""
@@ -50,6 +307,181 @@ def dump_pb(dir_or_filename):
         dump_tensorproto_pb_file(dir_or_filename)
 
 
+# elements per chunk of the streaming summaries, so that their temporaries stay a few MB for tensors of any size
+SUMMARY_CHUNK_ELEMENTS = 1 << 20
+
+
+def _read_tensor_for_summary(filename):
+    # a view of the mapped file if possible, so that the data is only paged in chunk by chunk
+    return read_tensorproto_pb_file_mmap(filename) or read_tensorproto_pb_file(filename)
+
+
+def _iterate_tensors(dir_or_filename):
+    # (label, name, data) of the tensors in a pb file, a test data container or the files of a directory
+    if os.path.isdir(dir_or_filename):
+        filenames = sorted(glob.glob(os.path.join(dir_or_filename, "*.pb")))
+        container = os.path.join(dir_or_filename, TEST_DATA_CONTAINER_FILE)
+        if os.path.exists(container):
+            filenames.append(container)
+    else:
+        filenames = [dir_or_filename]
+    for filename in filenames:
+        if os.path.basename(filename) == TEST_DATA_CONTAINER_FILE:
+            inputs, outputs = load_test_data_container(filename)
+            for prefix, name_data_map in [("input", inputs), ("output", outputs)]:
+                for i, (name, data) in enumerate(name_data_map.items()):
+                    yield "{}:{}_{}".format(os.path.basename(filename), prefix, i), name, data
+        else:
+            name, data = _read_tensor_for_summary(filename)
+            yield os.path.basename(filename), name, data
+
+
+def _iterate_chunks(*arrays):
+    # equally sized chunks of the flattened arrays, as float64 so that sums of float16 and integers don't overflow
+    flat_arrays = [np.asarray(data).reshape(-1) for data in arrays]
+    for start in range(0, flat_arrays[0].size, SUMMARY_CHUNK_ELEMENTS):
+        yield [flat[start:start + SUMMARY_CHUNK_ELEMENTS].astype(np.float64) for flat in flat_arrays]
+
+
+def summarize_tensor(data, bins=10):
+    """
+    Return the statistics of a tensor, computed in chunks so that the memory used does not depend on its size.
+    For a read-only view of a memory mapped file the data is read from the file chunk by chunk.
+
+    :param data: numpy.ndarray of the tensor.
+    :param bins: Number of equal-width bins of the histogram of the finite values between min and max.
+    :return: Map with dtype, shape and size and, for numeric tensors, the NaN, +Inf and -Inf counts, and
+             min, max, mean, std and histogram (bin edges and counts) of the finite values.
+    """
+    data = np.asarray(data)
+    summary = {"dtype": data.dtype.name, "shape": list(data.shape), "size": int(data.size)}
+    if data.dtype.kind not in "biuf" or data.size == 0:
+        return summary
+
+    nan_count = posinf_count = neginf_count = 0
+    count = 0
+    mean = m2 = 0.0
+    min_value, max_value = np.inf, -np.inf
+    for (chunk,) in _iterate_chunks(data):
+        nan_count += int(np.count_nonzero(np.isnan(chunk)))
+        posinf_count += int(np.count_nonzero(chunk == np.inf))
+        neginf_count += int(np.count_nonzero(chunk == -np.inf))
+        finite = chunk[np.isfinite(chunk)]
+        if finite.size == 0:
+            continue
+        min_value = min(min_value, float(finite.min()))
+        max_value = max(max_value, float(finite.max()))
+        # merge the mean and sum of squared deviations of the chunk with those of the previous chunks
+        chunk_mean = float(finite.mean())
+        chunk_m2 = float(np.square(finite - chunk_mean).sum())
+        delta = chunk_mean - mean
+        total = count + finite.size
+        mean += delta * finite.size / total
+        m2 += chunk_m2 + delta * delta * count * finite.size / total
+        count = total
+
+    summary.update(nan=nan_count, posinf=posinf_count, neginf=neginf_count, finite=count)
+    if count == 0:
+        return summary
+    edges = np.histogram_bin_edges([min_value, max_value], bins=bins)
+    histogram = np.zeros(bins, dtype=np.int64)
+    for (chunk,) in _iterate_chunks(data):
+        histogram += np.histogram(chunk[np.isfinite(chunk)], bins=edges)[0]
+    summary.update(min=min_value, max=max_value, mean=mean, std=(m2 / count) ** 0.5,
+                   histogram={"edges": edges.tolist(), "counts": histogram.tolist()})
+    return summary
+
+
+def diff_tensors(expected, actual, rtol=1e-3, atol=1e-3):
+    """
+    Return the statistical difference of two tensors of the same shape, computed in chunks like summarize_tensor.
+
+    :return: Map with the mean and std of both tensors and, for numeric tensors, the number of elements that are not
+             close per numpy.isclose(actual, expected, rtol, atol), the NaN positions that differ, and over the elements
+             that are finite in both the max and mean absolute difference, the RMSE, the max relative difference and
+             the cosine similarity.
+    """
+    expected = np.asarray(expected)
+    actual = np.asarray(actual)
+    diff = {"dtype": [expected.dtype.name, actual.dtype.name], "shape": [list(expected.shape), list(actual.shape)]}
+    if expected.shape != actual.shape:
+        diff["equal"] = False
+        return diff
+    if expected.dtype.kind not in "biuf" or actual.dtype.kind not in "biuf":
+        diff["equal"] = bool(np.array_equal(expected, actual))
+        return diff
+
+    not_close = nan_mismatches = finite_count = 0
+    max_abs = max_rel = sum_abs = sum_squares = 0.0
+    dot = expected_squares = actual_squares = 0.0
+    for expected_chunk, actual_chunk in _iterate_chunks(expected, actual):
+        not_close += int(np.count_nonzero(~np.isclose(actual_chunk, expected_chunk, rtol=rtol, atol=atol, equal_nan=True)))
+        nan_mismatches += int(np.count_nonzero(np.isnan(expected_chunk) != np.isnan(actual_chunk)))
+        finite = np.isfinite(expected_chunk) & np.isfinite(actual_chunk)
+        expected_chunk = expected_chunk[finite]
+        actual_chunk = actual_chunk[finite]
+        finite_count += actual_chunk.size
+        abs_diff = np.abs(actual_chunk - expected_chunk)
+        if abs_diff.size:
+            max_abs = max(max_abs, float(abs_diff.max()))
+            nonzero = expected_chunk != 0
+            if nonzero.any():
+                max_rel = max(max_rel, float((abs_diff[nonzero] / np.abs(expected_chunk[nonzero])).max()))
+        sum_abs += float(abs_diff.sum())
+        sum_squares += float(np.square(abs_diff).sum())
+        dot += float(np.dot(expected_chunk, actual_chunk))
+        expected_squares += float(np.dot(expected_chunk, expected_chunk))
+        actual_squares += float(np.dot(actual_chunk, actual_chunk))
+
+    size = max(finite_count, 1)
+    expected_summary = summarize_tensor(expected, bins=1)
+    actual_summary = summarize_tensor(actual, bins=1)
+    norm = (expected_squares * actual_squares) ** 0.5
+    diff.update(
+        equal=not_close == 0 and nan_mismatches == 0,
+        not_close=not_close,
+        nan_mismatches=nan_mismatches,
+        max_abs_diff=max_abs,
+        mean_abs_diff=sum_abs / size,
+        rmse=(sum_squares / size) ** 0.5,
+        max_rel_diff=max_rel,
+        cosine_similarity=dot / norm if norm else None,
+        mean=[expected_summary.get("mean"), actual_summary.get("mean")],
+        std=[expected_summary.get("std"), actual_summary.get("std")],
+    )
+    return diff
+
+
+def summarize_pb(dir_or_filename, bins=10):
+    """Print the summary of the tensors of either a single .pb file or test data container, or all .pb files and
+    the container in a directory, instead of their data."""
+
+    for label, name, data in _iterate_tensors(dir_or_filename):
+        print("{} Name: {}".format(label, name))
+        print(json.dumps(summarize_tensor(data, bins)))
+
+
+def diff_pb(expected_dir_or_filename, actual_dir_or_filename, rtol=1e-3, atol=1e-3):
+    """Print the statistical difference of the tensors of two .pb files or test data containers, or of the files
+    with the same names in two directories. Return whether all tensors are close."""
+
+    expected = {label: data for label, _, data in _iterate_tensors(expected_dir_or_filename)}
+    actual = {label: data for label, _, data in _iterate_tensors(actual_dir_or_filename)}
+    if not os.path.isdir(expected_dir_or_filename) and len(expected) == 1 and len(actual) == 1:
+        # two single files, which may have different names
+        actual = {label: data for label, data in zip(expected, actual.values())}
+    all_close = True
+    for label in sorted(set(expected) | set(actual)):
+        if label not in expected or label not in actual:
+            print("{} only in {}".format(label, actual_dir_or_filename if label in actual else expected_dir_or_filename))
+            all_close = False
+            continue
+        diff = diff_tensors(expected[label], actual[label], rtol, atol)
+        all_close = all_close and diff["equal"]
+        print("{}: {}".format(label, json.dumps(diff)))
+    return all_close
+
+
 def numpy_to_pb(name, np_data, out_filename):
     """Convert numpy data to a protobuf file."""
 
@@ -57,12 +489,14 @@ def numpy_to_pb(name, np_data, out_filename):
     onnx.save_tensor(tensor, out_filename)
 
 
-def image_to_numpy(filename, shape, channels_last, add_batch_dim):
-    """Convert an image file into a numpy array."""
+def image_to_numpy(filename, shape, channels_last, add_batch_dim, mode=None):
+    """Convert an image file into a numpy array. If mode is given, e.g. "RGB", the image is converted to it first."""
 
     import PIL.Image  # from 'Pillow' package
 
     img = PIL.Image.open(filename)
+    if mode and img.mode != mode:
+        img = img.convert(mode)
     if shape:
         w, h = img.size
         new_w = shape[1]
@@ -75,7 +509,7 @@ def image_to_numpy(filename, shape, channels_last, add_batch_dim):
         ratio = w_ratio if w_ratio > h_ratio else h_ratio
         interim_w = int(w * ratio)
         interim_h = int(h * ratio)
-        img = img.resize((interim_w, interim_h), PIL.Image.ANTIALIAS)
+        img = img.resize((interim_w, interim_h), PIL.Image.LANCZOS)
 
         # center crop to the final target size
         left = (interim_w - new_w) / 2
@@ -85,6 +519,9 @@ def image_to_numpy(filename, shape, channels_last, add_batch_dim):
         img = img.crop((left, top, right, bottom))
 
     img_as_np = np.array(img).astype(np.float32)
+    if img_as_np.ndim == 2:
+        # single channel images, e.g. mode "L", have no channel axis
+        img_as_np = np.expand_dims(img_as_np, axis=2)
     if not channels_last:
         # HWC to CHW
         img_as_np = np.transpose(img_as_np, (2, 0, 1))
@@ -96,6 +533,76 @@ def image_to_numpy(filename, shape, channels_last, add_batch_dim):
     return img_as_np
 
 
+IMAGE_EXTENSIONS = (".bmp", ".gif", ".jpeg", ".jpg", ".png", ".ppm", ".tif", ".tiff", ".webp")
+
+
+def list_image_files(dir_or_pattern):
+    """Return the image files in a directory, or matching a glob pattern such as "images/**/*.jpg", sorted by path
+    so that the order of the images in a batch does not depend on the file system."""
+
+    if os.path.isdir(dir_or_pattern):
+        filenames = [os.path.join(dir_or_pattern, f) for f in os.listdir(dir_or_pattern)
+                     if f.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        filenames = glob.glob(dir_or_pattern, recursive=True)
+    return sorted(f for f in filenames if os.path.isfile(f))
+
+
+def images_to_numpy(filenames, shape, channels_last, executor, mode=None):
+    """Convert image files into one NCHW, or NHWC if channels_last, float32 batch in the order of filenames.
+    The images are decoded and resized by the executor; Pillow releases the GIL while doing so.
+    If mode is given, e.g. "RGB" or "L", the images are converted to it, otherwise they keep their own mode."""
+
+    def convert(filename):
+        return image_to_numpy(filename, shape, channels_last, False, mode)
+
+    batch = None
+    for i, img_np in enumerate(executor.map(convert, filenames)):
+        if batch is None:
+            # fill one preallocated batch instead of stacking a list of images, which would need twice the memory
+            batch = np.empty((len(filenames),) + img_np.shape, dtype=img_np.dtype)
+        elif img_np.shape != batch.shape[1:]:
+            raise ValueError(
+                "{} has shape {} instead of {}. Use --resize and --mode to give all images the same shape.".format(
+                    filenames[i], img_np.shape, batch.shape[1:]))
+        batch[i] = img_np
+    return batch
+
+
+def images_to_pb(name, filenames, out_filename, shape, channels_last, shards=1, workers=None, mode=None):
+    """
+    Convert image files into batches of images, and serialize each batch as a TensorProto to a pb file.
+
+    :param name: TensorProto.name of the batches.
+    :param filenames: Image files in the order of the batch, e.g. from list_image_files.
+    :param out_filename: pb file of the batch. With several shards, shard N is saved to <out_filename>_N.pb.
+    :param shape: Optional height and width to resize and center crop the images to.
+    :param channels_last: Save NHWC instead of NCHW batches.
+    :param shards: Number of batches to split the images into. The first images go into the first batch, and the
+                   batches differ in size by at most one image.
+    :param workers: Number of threads decoding and resizing the images. Defaults to the number of CPUs.
+    :param mode: Optional Pillow image mode, e.g. "RGB" or "L", to convert the images to.
+    :return: List of the pb files that were written.
+    """
+
+    if not filenames:
+        raise ValueError("No image files were provided.")
+    shards = min(shards, len(filenames))
+    if shards == 1:
+        out_filenames = [out_filename]
+    else:
+        root, ext = os.path.splitext(out_filename)
+        out_filenames = ["{}_{}{}".format(root, i, ext or ".pb") for i in range(shards)]
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        # one shard at a time, so that only one batch is in memory
+        for shard_filenames, shard_out_filename in zip(np.array_split(filenames, shards), out_filenames):
+            batch = images_to_numpy(list(shard_filenames), shape, channels_last, executor, mode)
+            numpy_to_pb(name, batch, shard_out_filename)
+            print("Saved {} images with shape {} to {}".format(len(batch), batch.shape, shard_out_filename))
+    return out_filenames
+
+
 def create_random_data(shape, type, minvalue, maxvalue, seed):
     nptype = np.dtype(type)
     np.random.seed(seed)
@@ -120,11 +627,21 @@ def get_arg_parser():
         Utilities for working with the input/output protobuf files used by the ONNX test cases and onnx_test_runner.
         These are expected to only contain a serialized TensorProto.
         dump_pb: Dumps the TensorProto data from an individual pb file, or all pb files in a directory.
+                 With --summary, only the shape, dtype, min/max/mean/std, NaN/Inf counts and a histogram of each
+                 tensor are computed, in chunks, so that tensors of any size can be inspected.
+        diff_pb: Compare the tensors of the --input pb file or directory with those of --other statistically.
+                 Exits with 1 if any tensor is not close per --rtol and --atol.
         numpy_to_pb: Convert numpy array saved to a file with numpy.save() to a TensorProto, and serialize to a pb file.
         image_to_pb: Convert data from an image file into a TensorProto, and serialize to a pb file.
+        images_to_pb: Convert the images in a directory, or matching a glob pattern, into one batch of images in
+                      a TensorProto, or into --shards batches, and serialize each batch to a pb file.
+                      The images are decoded in parallel and batched in the order of their paths.
         random_to_pb: Create a TensorProto with random data, and serialize to a pb file.
         update_name_in_pb: Update the TensorProto.name value in a pb file.
                            Updates the input file unless --output <filename> is specified.
+        pb_to_container: Convert the .pb files of a test_data_set directory, or of all test_data_set directories
+                         in a directory, into a test_data.npt container that can be memory mapped.
+                         The .pb files are removed if --remove_pb is specified.
         """,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
@@ -132,7 +649,10 @@ def get_arg_parser():
     parser.add_argument(
         "--action",
         help="Action to perform",
-        choices=["dump_pb", "numpy_to_pb", "image_to_pb", "random_to_pb", "update_name_in_pb"],
+        choices=[
+            "dump_pb", "diff_pb", "numpy_to_pb", "image_to_pb", "images_to_pb", "random_to_pb", "update_name_in_pb",
+            "pb_to_container",
+        ],
         required=True,
     )
 
@@ -140,6 +660,15 @@ def get_arg_parser():
     parser.add_argument("--name", help="The value to set TensorProto.name to if creating/updating one.")
     parser.add_argument("--output", help="Filename to serialize the TensorProto to.")
 
+    dump_pb_group = parser.add_argument_group("dump_pb", "dump_pb and diff_pb specific options")
+    dump_pb_group.add_argument(
+        "--summary", action="store_true", help="Print a summary of each tensor instead of its data."
+    )
+    dump_pb_group.add_argument("--bins", default=10, type=int, help="Number of bins of the histogram of --summary.")
+    dump_pb_group.add_argument("--other", help="The pb file or directory to compare --input with.")
+    dump_pb_group.add_argument("--rtol", default=1e-3, type=float, help="Relative tolerance of diff_pb.")
+    dump_pb_group.add_argument("--atol", default=1e-3, type=float, help="Absolute tolerance of diff_pb.")
+
     image_to_pb_group = parser.add_argument_group("image_to_pb", "image_to_pb specific options")
     image_to_pb_group.add_argument(
         "--resize",
@@ -156,6 +685,22 @@ def get_arg_parser():
         action="store_true",
         help="Prepend a batch dimension with value of 1 to the shape. " "i.e. convert from CHW to NCHW",
     )
+    image_to_pb_group.add_argument(
+        "--mode",
+        default=None,
+        help="Pillow image mode to convert the image to, e.g. RGB, or L for grayscale. "
+        "Defaults to the mode of the image file.",
+    )
+
+    images_to_pb_group = parser.add_argument_group(
+        "images_to_pb", "images_to_pb specific options. --resize, --channels_last and --mode also apply."
+    )
+    images_to_pb_group.add_argument(
+        "--shards", default=1, type=int, help="Split the images into this many batches, saved to <output>_N.pb."
+    )
+    images_to_pb_group.add_argument(
+        "--workers", default=None, type=int, help="Number of threads decoding the images. Defaults to the CPU count."
+    )
 
     random_to_pb_group = parser.add_argument_group("random_to_pb", "random_to_pb specific options")
     random_to_pb_group.add_argument(
@@ -178,6 +723,11 @@ def get_arg_parser():
         "--seed", default=None, type=int, help="seed to use for the random values so they're deterministic."
     )
 
+    pb_to_container_group = parser.add_argument_group("pb_to_container", "pb_to_container specific options")
+    pb_to_container_group.add_argument(
+        "--remove_pb", action="store_true", help="Remove the .pb files after converting them."
+    )
+
     return parser
 
 
@@ -189,8 +739,17 @@ if __name__ == "__main__":
         if not args.input:
             print("Missing argument. Need input to be specified.", file=sys.stderr)
             sys.exit(-1)
-        np.set_printoptions(precision=10)
-        dump_pb(args.input)
+        if args.summary:
+            summarize_pb(args.input, args.bins)
+        else:
+            np.set_printoptions(precision=10)
+            dump_pb(args.input)
+    elif args.action == "diff_pb":
+        if not args.input or not args.other:
+            print("Missing argument. Need input and other to be specified.", file=sys.stderr)
+            sys.exit(-1)
+        if not diff_pb(args.input, args.other, args.rtol, args.atol):
+            sys.exit(1)
     elif args.action == "numpy_to_pb":
         if not args.input or not args.output or not args.name:
             print("Missing argument. Need input, output and name to be specified.", file=sys.stderr)
@@ -203,8 +762,19 @@ if __name__ == "__main__":
             print("Missing argument. Need input, output, name to be specified.", file=sys.stderr)
             sys.exit(-1)
 
-        img_np = image_to_numpy(args.input, args.resize, args.channels_last, args.add_batch_dim)
+        img_np = image_to_numpy(args.input, args.resize, args.channels_last, args.add_batch_dim, args.mode)
         numpy_to_pb(args.name, img_np, args.output)
+    elif args.action == "images_to_pb":
+        if not args.input or not args.output or not args.name:
+            print("Missing argument. Need input, output, name to be specified.", file=sys.stderr)
+            sys.exit(-1)
+
+        image_files = list_image_files(args.input)
+        if not image_files:
+            print("No image files were found in {}.".format(args.input), file=sys.stderr)
+            sys.exit(-1)
+        images_to_pb(args.name, image_files, args.output, args.resize, args.channels_last, args.shards, args.workers,
+                     args.mode)
     elif args.action == "random_to_pb":
         if not args.output or not args.shape or not args.datatype or not args.name:
             print("Missing argument. Need output, shape, datatype and name to be specified.", file=sys.stderr)
@@ -218,6 +788,16 @@ if __name__ == "__main__":
             sys.exit(-1)
 
         update_name_in_pb(args.input, args.name, args.output)
+    elif args.action == "pb_to_container":
+        if not args.input:
+            print("Missing argument. Need input to be specified.", file=sys.stderr)
+            sys.exit(-1)
+
+        test_dirs = [d for d in glob.glob(os.path.join(args.input, "test_data_set_*")) if os.path.isdir(d)]
+        for d in sorted(test_dirs) or [args.input]:
+            container = pb_dir_to_container(d, args.remove_pb)
+            if container:
+                print("Created {}".format(container))
     else:
         print("Unknown action.", file=sys.stderr)
         arg_parser.print_help(sys.stderr)
@@ -6,10 +6,15 @@
 import glob
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
+import benchmark_utils
+from bound_session import BoundSession
 import numpy as np
 import onnx
 import onnx_test_data_utils
+import output_compare
+from model_handle import ModelHandle, as_model_handle
 from onnx import numpy_helper
 
 import onnxruntime as ort
@@ -74,7 +79,8 @@ def _create_missing_input_data(model_inputs, name_input_map, symbolic_dim_values
 
 
 def create_test_dir(
-    model_path, root_path, test_name, name_input_map=None, symbolic_dim_values_map=None, name_output_map=None
+    model_path, root_path, test_name, name_input_map=None, symbolic_dim_values_map=None, name_output_map=None,
+    model=None, data_format="pb", io_binding=False
 ):
     """
     Create a test directory that can be used with onnx_test_runner or onnxruntime_perf_test.
@@ -89,6 +95,10 @@ def create_test_dir(
                                     using random data.
     :param name_output_map: Optional map of output names to numpy ndarray expected output data.
                             If not provided, the model will be run with the input to generate output data to save.
+    :param model: Optional ModelHandle of the model at model_path, so that the model is not loaded again.
+    :param data_format: "pb" to save each input and output as a serialized TensorProto in input_N.pb/output_N.pb,
+                        or "container" to save them all in one onnx_test_data_utils.TEST_DATA_CONTAINER_FILE.
+    :param io_binding: Run the model through model.bound_session, whose output buffers are reused by the test runs.
     :return: None
     """
 
@@ -112,12 +122,16 @@ def create_test_dir(
     test_model_filename = os.path.join(test_dir, model_filename)
     shutil.copy(model_path, test_model_filename)
 
-    model = onnx.load(model_path)
-    model_inputs = model.graph.input
-    model_outputs = model.graph.output
+    if model is None:
+        model = ModelHandle(model_path)
+    model_inputs = model.proto.graph.input
+    model_outputs = model.proto.graph.output
+
+    container_data = {}
 
     def save_data(prefix, name_data_map, model_info):
         idx = 0
+        container_data[prefix] = []
         for name, data in name_data_map.items():
             if isinstance(data, dict):
                 # ignore. map<T1, T2> from traditional ML ops
@@ -125,6 +139,9 @@ def create_test_dir(
             elif isinstance(data, list):
                 # ignore. vector<map<T1,T2>> from traditional ML ops. e.g. ZipMap output
                 pass
+            elif data_format == "container":
+                np_type = _get_numpy_type(model_info, name)
+                container_data[prefix].append((name, data.astype(np_type)))
             else:
                 np_type = _get_numpy_type(model_info, name)
                 tensor = numpy_helper.from_array(data.astype(np_type), name)
@@ -139,67 +156,270 @@ def create_test_dir(
 
     if not symbolic_dim_values_map:
         symbolic_dim_values_map = {}
-    initializer_set = set()
-    for initializer in onnx.load(model_path).graph.initializer:
-        initializer_set.add(initializer.name)
+    initializer_set = model.initializer_names
     _create_missing_input_data(model_inputs, name_input_map, symbolic_dim_values_map, initializer_set)
     save_data("input", name_input_map, model_inputs)
 
     # save expected output data if provided. run model to create if not.
     if not name_output_map:
         output_names = [o.name for o in model_outputs]
-        sess = ort.InferenceSession(test_model_filename)
+        sess = model.bound_session if io_binding else model.session
         outputs = sess.run(output_names, name_input_map)
         name_output_map = {}
         for name, data in zip(output_names, outputs):
             name_output_map[name] = data
 
     save_data("output", name_output_map, model_outputs)
+    if data_format == "container":
+        onnx_test_data_utils.save_test_data_container(
+            os.path.join(test_data_dir, onnx_test_data_utils.TEST_DATA_CONTAINER_FILE),
+            container_data["input"], container_data["output"])
+
+
+def _read_tensorproto_pb_file(filename, use_mmap):
+    if use_mmap:
+        name_data = onnx_test_data_utils.read_tensorproto_pb_file_mmap(filename)
+        if name_data is not None:
+            return name_data
+    return onnx_test_data_utils.read_tensorproto_pb_file(filename)
 
 
-def read_test_dir(dir_name, input_types, output_types):
+def read_test_dir(dir_name, input_types, output_types, use_mmap=True, executor=None):
     """
     Read the input and output .pb files from the provided directory.
     Input files should have a prefix of 'input_'
     Output files, which are optional, should have a prefix of 'output_'
+    If the directory has an onnx_test_data_utils.TEST_DATA_CONTAINER_FILE, the data is read from it instead.
     :param dir_name: Directory to read files from
+    :param use_mmap: Return read-only views of the memory mapped raw_data of the tensors instead of copies.
+                     Tensors without raw_data are always parsed and copied.
+    :param executor: Optional concurrent.futures.Executor to decode the files concurrently.
+                     protobuf parsing releases the GIL, so a ThreadPoolExecutor decodes large files in parallel.
     :return: tuple(dictionary of input name to numpy.ndarray of data,
                    dictionary of output name to numpy.ndarray)
     """
 
+    container = os.path.join(dir_name, onnx_test_data_utils.TEST_DATA_CONTAINER_FILE)
+    if os.path.exists(container):
+        return onnx_test_data_utils.load_test_data_container(container)
+
     inputs = {}
     outputs = {}
 
-    input_files = glob.glob(os.path.join(dir_name, "input_*.pb"))
-    output_files = glob.glob(os.path.join(dir_name, "output_*.pb"))
+    input_files = sorted(glob.glob(os.path.join(dir_name, "input_*.pb")), key=_get_pb_file_index)
+    output_files = sorted(glob.glob(os.path.join(dir_name, "output_*.pb")), key=_get_pb_file_index)
 
-    for i, filename in enumerate(input_files):
-        if 'seq' in input_types[i]:
-            name, data = onnx_test_data_utils.read_sequenceproto_pb_file(filename)
-        else:
-            name, data = onnx_test_data_utils.read_tensorproto_pb_file(filename)
-        inputs[name] = data
+    def read_file(filename, is_sequence):
+        if is_sequence:
+            return onnx_test_data_utils.read_sequenceproto_pb_file(filename)
+        return _read_tensorproto_pb_file(filename, use_mmap)
 
+    decodes = []
+    for i, filename in enumerate(input_files):
+        decodes.append((inputs, read_file, filename, i < len(input_types) and 'seq' in input_types[i]))
     for i, filename in enumerate(output_files):
-        if 'seq' in output_files[i]:
-            name, data = onnx_test_data_utils.read_sequenceproto_pb_file(filename)
-        else:
-            name, data = onnx_test_data_utils.read_tensorproto_pb_file(filename)
-        outputs[name] = data
+        decodes.append((outputs, read_file, filename, 'seq' in output_files[i]))
+    _decode_all(decodes, executor)
 
     return inputs, outputs
 
 
-def run_test_dir(model_or_dir):
+def _decode_all(decodes, executor):
+    # decodes is a list of (name_data_map, decode function, data, is_sequence). Fills the maps in the order of the
+    # list so that the output names keep the order of the files.
+    if executor is None:
+        results = [decode(data, is_sequence) for _, decode, data, is_sequence in decodes]
+    else:
+        futures = [executor.submit(decode, data, is_sequence) for _, decode, data, is_sequence in decodes]
+        results = [future.result() for future in futures]
+    for (name_data_map, _, _, _), (name, data) in zip(decodes, results):
+        name_data_map[name] = data
+
+
+def _iterate_prefetched(test_data_sets, read_data_set):
+    # yield (test data set, read_data_set(test data set)) while the next test data set is read in the background
+    if not test_data_sets:
+        return
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_data = prefetcher.submit(read_data_set, test_data_sets[0])
+        for i, test_data_set in enumerate(test_data_sets):
+            data = next_data.result()
+            if i + 1 < len(test_data_sets):
+                next_data = prefetcher.submit(read_data_set, test_data_sets[i + 1])
+            yield test_data_set, data
+
+
+def _get_decode_workers():
+    return min(8, os.cpu_count() or 1)
+
+
+def _get_pb_file_index(filename):
+    # input_<N>.pb / output_<N>.pb -> N
+    return int(os.path.splitext(filename)[0].split("_")[-1])
+
+
+def read_test_data(pb_files, input_types, output_types, executor=None):
+    """
+    Decode the input and output .pb files of one test_data_set that were read into memory,
+    e.g. streamed out of a .tar.gz by test_utils.stream_test_data.
+    :param pb_files: Map of .pb file name to the serialized bytes of the file. May hold the bytes of an
+                     onnx_test_data_utils.TEST_DATA_CONTAINER_FILE instead.
+    :param executor: Optional concurrent.futures.Executor to decode the files concurrently.
+    :return: tuple(dictionary of input name to numpy.ndarray of data,
+                   dictionary of output name to numpy.ndarray)
     """
-    Run the test/s from a directory in ONNX test format.
-    All subdirectories with a prefix of 'test' are considered test input for one test run.
 
-    :param model_or_dir: Path to onnx model in test directory,
-                         or the test directory name if the directory only contains one .onnx model.
-    :return: None
+    if onnx_test_data_utils.TEST_DATA_CONTAINER_FILE in pb_files:
+        return onnx_test_data_utils.load_test_data_container(pb_files[onnx_test_data_utils.TEST_DATA_CONTAINER_FILE])
+
+    inputs = {}
+    outputs = {}
+
+    def read_bytes(data, is_sequence):
+        if is_sequence:
+            return onnx_test_data_utils.read_sequenceproto_pb_bytes(data)
+        return onnx_test_data_utils.read_tensorproto_pb_bytes(data)
+
+    decodes = []
+    for prefix, types, name_data_map in [("input_", input_types, inputs), ("output_", output_types, outputs)]:
+        filenames = sorted((f for f in pb_files if f.startswith(prefix) and f.endswith(".pb")), key=_get_pb_file_index)
+        for i, filename in enumerate(filenames):
+            decodes.append((name_data_map, read_bytes, pb_files[filename], i < len(types) and 'seq' in types[i]))
+    _decode_all(decodes, executor)
+
+    return inputs, outputs
+
+
+def _get_output_names(sess, expected_outputs):
+    if expected_outputs:
+        output_names = list(expected_outputs.keys())
+        # handle case where there's a single expected output file but no name in it (empty string for name)
+        # e.g. ONNX test models 20190729\opset8\tf_mobilenet_v2_1.4_224
+        if len(output_names) == 1 and output_names[0] == "":
+            output_names = [o.name for o in sess.get_outputs()]
+            assert len(output_names) == 1, "There should be single output_name."
+            expected_outputs[output_names[0]] = expected_outputs[""]
+            expected_outputs.pop("")
+
+    else:
+        output_names = [o.name for o in sess.get_outputs()]
+    return output_names
+
+
+def _outputs_match(output_names, expected_outputs, run_outputs, tolerances=None):
+    if not expected_outputs:
+        return True
+    reports = output_compare.compare_outputs(output_names, expected_outputs, run_outputs, tolerances)
+    return all(report["passed"] for report in reports)
+
+
+def _check_outputs(output_names, expected_outputs, run_outputs, tolerances):
+    reports = []
+    if expected_outputs:
+        reports = output_compare.compare_outputs(output_names, expected_outputs, run_outputs, tolerances)
+        for report in reports:
+            if not report["passed"]:
+                # the error statistics instead of the arrays, which can be hundreds of MB
+                print("Mismatch for {}: {}".format(report["name"], output_compare.format_report(report)))
+    if not all(report["passed"] for report in reports):
+        raise ValueError("FAILED due to output mismatch.")
+    else:
+        print("PASS")
+    return reports
+
+
+def _run_test_data_set(sess, inputs, expected_outputs, tolerances=None):
+    output_names = _get_output_names(sess, expected_outputs)
+
+    run_outputs = sess.run(output_names, inputs)
+    return _check_outputs(output_names, expected_outputs, run_outputs, tolerances)
+
+
+def _has_dynamic_batch_axis(sess):
+    # the same named symbolic dim, e.g. "batch_size" or "N", leading every input and output. Unknown or
+    # differently named leading dims may be unrelated to the batch, e.g. the count of a NonZero output.
+    args = sess.get_inputs() + sess.get_outputs()
+    if not all(arg.type.startswith("tensor") and len(arg.shape) > 0 for arg in args):
+        return False
+    leading_dims = {arg.shape[0] for arg in args}
+    return len(leading_dims) == 1 and isinstance(next(iter(leading_dims)), str)
+
+
+def _get_stack_key(inputs, output_names):
+    # test_data_sets with the same key can be concatenated along the batch axis. None if this one can't be.
+    if not inputs or not all(isinstance(data, np.ndarray) and data.ndim > 0 for data in inputs.values()):
+        return None
+    if len({data.shape[0] for data in inputs.values()}) != 1:
+        return None
+    return tuple(sorted((name, data.dtype.str, data.shape[1:]) for name, data in inputs.items())), tuple(output_names)
+
+
+def _run_stacked_test_data_sets(sess, data_sets, tolerances):
     """
+    Run the test_data_sets whose inputs only differ in the batch size as one batch: concatenate their inputs along
+    the batch axis, run them with one sess.run call and split the outputs back for the comparison of each set.
+    test_data_sets that can't be stacked with any other set are run on their own.
 
+    :param data_sets: List of tuple(test_data_set name, inputs, expected_outputs).
+    :return: Map of test_data_set name to the list of output_compare reports of its outputs.
+    """
+    groups = {}
+    for name, inputs, expected_outputs in data_sets:
+        output_names = _get_output_names(sess, expected_outputs)
+        key = _get_stack_key(inputs, output_names) if _has_dynamic_batch_axis(sess) else None
+        groups.setdefault(key if key is not None else name, []).append((name, inputs, expected_outputs))
+
+    reports = {}
+    for group in groups.values():
+        output_names = _get_output_names(sess, group[0][2])
+        batch_sizes = [next(iter(inputs.values())).shape[0] for _, inputs, _ in group]
+        run_outputs = None
+        if len(group) > 1:
+            try:
+                stacked_inputs = {input_name: np.concatenate([inputs[input_name] for _, inputs, _ in group])
+                                  for input_name in group[0][1]}
+                run_outputs = sess.run(output_names, stacked_inputs)
+            except Exception as e:
+                # e.g. a reshape to a fixed batch size, or out of memory for the bigger batch. The sets are run
+                # one at a time instead, so they only fail if they fail on their own
+                print("Could not run {} as one batch, running them one at a time: {}".format(
+                    ", ".join(name for name, _, _ in group), e))
+            if run_outputs is not None and any(
+                    not isinstance(output, np.ndarray) or output.ndim == 0 or output.shape[0] != sum(batch_sizes)
+                    for output in run_outputs):
+                # the outputs are not batched like the inputs, e.g. a reduction over the batch
+                run_outputs = None
+            elif run_outputs is not None:
+                print("Ran {} as one batch of {}".format(", ".join(name for name, _, _ in group), sum(batch_sizes)))
+        if run_outputs is None:
+            for name, inputs, expected_outputs in group:
+                print(name)
+                reports[name] = _run_test_data_set(sess, inputs, expected_outputs, tolerances)
+            continue
+
+        split_points = np.cumsum(batch_sizes)[:-1]
+        split_outputs = [np.split(output, split_points) for output in run_outputs]
+        for i, (name, _, expected_outputs) in enumerate(group):
+            print(name)
+            reports[name] = _check_outputs(
+                output_names, expected_outputs, [outputs[i] for outputs in split_outputs], tolerances)
+    return reports
+
+
+def _run_test_data_sets(sess, test_data_sets, read_data_set, tolerances, stack_batches):
+    if stack_batches:
+        data_sets = [(name, inputs, expected_outputs)
+                     for name, (inputs, expected_outputs) in _iterate_prefetched(test_data_sets, read_data_set)]
+        return _run_stacked_test_data_sets(sess, data_sets, tolerances)
+    reports = {}
+    for name, (inputs, expected_outputs) in _iterate_prefetched(test_data_sets, read_data_set):
+        print(name)
+        reports[name] = _run_test_data_set(sess, inputs, expected_outputs, tolerances)
+    return reports
+
+
+def _get_test_dirs(model_or_dir):
+    # return the model path and the test_data_set directories of a test directory in ONNX test format
     if os.path.isdir(model_or_dir):
         model_dir = os.path.abspath(model_or_dir)
         # check there's only one onnx file
@@ -219,49 +439,210 @@ def run_test_dir(model_or_dir):
         model_path = os.path.abspath(model_or_dir)
         model_dir = os.path.dirname(model_path)
 
-    print("Running tests in {} for {}".format(model_dir, model_path))
-
     test_dirs = [d for d in glob.glob(os.path.join(model_dir, "test*")) if os.path.isdir(d)]
     if not test_dirs:
         raise ValueError("No directories with name starting with 'test' were found in {}.".format(model_dir))
-    sess = ort.InferenceSession(model_path)
+    return model_path, sorted(test_dirs)
+
+
+def run_test_dir(model_or_dir, model=None, tolerances=None, stack_batches=False, io_binding=False):
+    """
+    Run the test/s from a directory in ONNX test format.
+    All subdirectories with a prefix of 'test' are considered test input for one test run.
+
+    :param model_or_dir: Path to onnx model in test directory,
+                         or the test directory name if the directory only contains one .onnx model.
+    :param model: Optional ModelHandle of the model in the test directory to create the InferenceSession from.
+    :param tolerances: Optional per-dtype tolerances of the outputs, see output_compare.load_tolerances.
+    :param stack_batches: If the model has a dynamic batch axis, run the test directories whose inputs only differ
+                          in the batch size as one batch.
+    :param io_binding: Run the tests through IOBinding with output buffers that are reused by all test directories
+                       with inputs of the same shapes. See bound_session.BoundSession.
+    :return: Map of test directory to the list of output_compare reports of its outputs.
+    """
+
+    model_path, test_dirs = _get_test_dirs(model_or_dir)
+    print("Running tests in {} for {}".format(os.path.dirname(model_path), model_path))
+    sess = model.session if model is not None else ort.InferenceSession(model_path)
+    if io_binding:
+        sess = model.bound_session if model is not None else BoundSession(sess)
 
     input_types = [inp.type for inp in sess.get_inputs()]
     output_types = [out.type for out in sess.get_outputs()]
 
-    for d in test_dirs:
-        print(d)
-        inputs, expected_outputs = read_test_dir(d, input_types, output_types)
-
-        if expected_outputs:
-            output_names = list(expected_outputs.keys())
-            # handle case where there's a single expected output file but no name in it (empty string for name)
-            # e.g. ONNX test models 20190729\opset8\tf_mobilenet_v2_1.4_224
-            if len(output_names) == 1 and output_names[0] == "":
-                output_names = [o.name for o in sess.get_outputs()]
-                assert len(output_names) == 1, "There should be single output_name."
-                expected_outputs[output_names[0]] = expected_outputs[""]
-                expected_outputs.pop("")
-
-        else:
-            output_names = [o.name for o in sess.get_outputs()]
+    # decode the files of a test_data_set concurrently, and the next test_data_set while this one runs
+    with ThreadPoolExecutor(max_workers=_get_decode_workers()) as decoder:
+        def read_data_set(d):
+            return read_test_dir(d, input_types, output_types, executor=decoder)
 
-        run_outputs = sess.run(output_names, inputs)
-        failed = False
-        if expected_outputs:
-            for idx in range(len(output_names)):
-                expected = expected_outputs[output_names[idx]]
-                actual = run_outputs[idx]
-
-                if expected.dtype.char in np.typecodes["AllFloat"]:
-                    if not np.isclose(expected, actual, rtol=1.0e-3, atol=1.0e-3).all():
-                        print("Mismatch for {}:\nExpected:{}\nGot:{}".format(output_names[idx], expected, actual))
-                        failed = True
-                else:
-                    if not np.equal(expected, actual).all():
-                        print("Mismatch for {}:\nExpected:{}\nGot:{}".format(output_names[idx], expected, actual))
-                        failed = True
-        if failed:
-            raise ValueError("FAILED due to output mismatch.")
-        else:
-            print("PASS")
+        reports = _run_test_data_sets(sess, test_dirs, read_data_set, tolerances, stack_batches)
+    if io_binding:
+        print(sess.format_stats())
+    return reports
+
+
+def run_test_data(model, test_data_sets, tolerances=None, stack_batches=False, io_binding=False):
+    """
+    Run the tests from test data that is already in memory instead of in a test directory.
+
+    :param model: Path to the onnx model, or a ModelHandle of it.
+    :param test_data_sets: Map of test_data_set name to a map of .pb file name to the serialized bytes of the file,
+                           as returned by test_utils.stream_test_data.
+    :param tolerances: Optional per-dtype tolerances of the outputs, see output_compare.load_tolerances.
+    :param stack_batches: Same as for run_test_dir.
+    :param io_binding: Same as for run_test_dir.
+    :return: Map of test_data_set name to the list of output_compare reports of its outputs.
+    """
+
+    if not test_data_sets:
+        raise ValueError("No test data sets were provided.")
+    model = as_model_handle(model)
+    sess = model.bound_session if io_binding else model.session
+
+    input_types = [inp.type for inp in sess.get_inputs()]
+    output_types = [out.type for out in sess.get_outputs()]
+
+    with ThreadPoolExecutor(max_workers=_get_decode_workers()) as decoder:
+        def read_data_set(name):
+            return read_test_data(test_data_sets[name], input_types, output_types, executor=decoder)
+
+        reports = _run_test_data_sets(sess, sorted(test_data_sets), read_data_set, tolerances, stack_batches)
+    if io_binding:
+        print(sess.format_stats())
+    return reports
+
+
+def _benchmark_test_data_sets(model, test_data_sets, read_data_set, warmup_iterations, iterations, io_binding):
+    sess = model.bound_session if io_binding else model.session
+    input_types = [inp.type for inp in sess.get_inputs()]
+    output_types = [out.type for out in sess.get_outputs()]
+    output_names = [out.name for out in sess.get_outputs()]
+
+    records = []
+    for name in test_data_sets:
+        inputs, _ = read_data_set(name, input_types, output_types)
+        stats = sess.get_stats() if io_binding else None
+        latencies = benchmark_utils.time_runs(sess, output_names, inputs, warmup_iterations, iterations)
+        record = {
+            "model": os.path.basename(model.model_path),
+            "test_data_set": os.path.basename(name),
+            "session_creation_ms": round(model.session_seconds * 1000, 4),
+            "warmup_iterations": warmup_iterations,
+            "io_binding": io_binding,
+        }
+        record.update(benchmark_utils.summarize_latencies(latencies))
+        if io_binding:
+            # the savings of the runs of this test_data_set only
+            record.update({k: round(v - stats[k], 4) for k, v in sess.get_stats().items()})
+        print("{}: p50 {} ms, p90 {} ms, p99 {} ms, {} runs/s".format(
+            record["test_data_set"], record.get("p50_ms"), record.get("p90_ms"), record.get("p99_ms"),
+            record.get("throughput_per_sec")))
+        records.append(record)
+    return records
+
+
+def benchmark_test_dir(model_or_dir, model=None, warmup_iterations=5, iterations=20, io_binding=False):
+    """
+    Measure the latency and throughput of a model with the inputs of each test_data_set in a directory in ONNX test
+    format. The expected outputs are not compared; use run_test_dir for that.
+
+    :param model_or_dir: Path to onnx model in test directory,
+                         or the test directory name if the directory only contains one .onnx model.
+    :param model: Optional ModelHandle of the model in the test directory whose InferenceSession is reused.
+    :param warmup_iterations: Number of untimed runs per test_data_set.
+    :param iterations: Number of timed runs per test_data_set.
+    :param io_binding: Measure the runs through IOBinding with reused output buffers, i.e. without the output
+                       allocations of sess.run, and add the allocations that saved to the results.
+    :return: List with a map of the benchmark results for each test_data_set.
+    """
+
+    model_path, test_dirs = _get_test_dirs(model_or_dir)
+    if model is None:
+        model = ModelHandle(model_path)
+    return _benchmark_test_data_sets(model, test_dirs, read_test_dir, warmup_iterations, iterations, io_binding)
+
+
+def benchmark_test_data(model, test_data_sets, warmup_iterations=5, iterations=20, io_binding=False):
+    """
+    Same as benchmark_test_dir for test data that is already in memory.
+
+    :param model: Path to the onnx model, or a ModelHandle of it.
+    :param test_data_sets: Map of test_data_set name to a map of .pb file name to the serialized bytes of the file,
+                           as returned by test_utils.stream_test_data.
+    :return: List with a map of the benchmark results for each test_data_set.
+    """
+
+    def read_data_set(name, input_types, output_types):
+        return read_test_data(test_data_sets[name], input_types, output_types)
+
+    return _benchmark_test_data_sets(as_model_handle(model), sorted(test_data_sets), read_data_set,
+                                     warmup_iterations, iterations, io_binding)
+
+
+def _stress_test_data_sets(model, test_data_sets, read_data_set, thread_counts, iterations, tolerances):
+    sess = model.session
+    input_types = [inp.type for inp in sess.get_inputs()]
+    output_types = [out.type for out in sess.get_outputs()]
+
+    runs = []
+    for name in test_data_sets:
+        inputs, expected_outputs = read_data_set(name, input_types, output_types)
+        runs.append((_get_output_names(sess, expected_outputs), inputs, expected_outputs))
+
+    records = []
+    for threads in thread_counts:
+        latencies, wall_seconds, mismatches = benchmark_utils.time_concurrent_runs(
+            sess, runs, threads, iterations,
+            lambda names, expected, outputs: _outputs_match(names, expected, outputs, tolerances))
+        record = {"model": os.path.basename(model.model_path), "threads": threads}
+        record.update(benchmark_utils.summarize_latencies(latencies))
+        # the runs overlap, so the throughput is the number of runs over the wall-clock time of all of them
+        record.pop("throughput_per_sec", None)
+        record["qps"] = round(len(latencies) / wall_seconds, 2)
+        record["mismatches"] = mismatches
+        print("{} threads: {} runs/s, p50 {} ms, p99 {} ms, {} mismatches".format(
+            threads, record["qps"], record.get("p50_ms"), record.get("p99_ms"), mismatches))
+        records.append(record)
+
+    mismatches = sum(record["mismatches"] for record in records)
+    if mismatches:
+        raise ValueError("FAILED due to output mismatch in {} concurrent runs.".format(mismatches))
+    return records
+
+
+def stress_test_dir(model_or_dir, model=None, thread_counts=(1, 2, 4, 8), iterations=20, tolerances=None):
+    """
+    Replay the test_data_set_N of a directory in ONNX test format from several threads against one shared
+    InferenceSession, check that the outputs stay within tolerance and measure how the throughput and
+    latency scale with the number of threads.
+
+    :param model_or_dir: Path to onnx model in test directory,
+                         or the test directory name if the directory only contains one .onnx model.
+    :param model: Optional ModelHandle of the model in the test directory whose InferenceSession is shared.
+    :param thread_counts: Numbers of concurrent threads to measure.
+    :param iterations: Number of runs per thread.
+    :param tolerances: Optional per-dtype tolerances of the outputs, see output_compare.load_tolerances.
+    :return: List with a map of the results for each thread count.
+    """
+
+    model_path, test_dirs = _get_test_dirs(model_or_dir)
+    if model is None:
+        model = ModelHandle(model_path)
+    return _stress_test_data_sets(model, test_dirs, read_test_dir, thread_counts, iterations, tolerances)
+
+
+def stress_test_data(model, test_data_sets, thread_counts=(1, 2, 4, 8), iterations=20, tolerances=None):
+    """
+    Same as stress_test_dir for test data that is already in memory.
+
+    :param model: Path to the onnx model, or a ModelHandle of it.
+    :param test_data_sets: Map of test_data_set name to a map of .pb file name to the serialized bytes of the file,
+                           as returned by test_utils.stream_test_data.
+    :return: List with a map of the results for each thread count.
+    """
+
+    def read_data_set(name, input_types, output_types):
+        return read_test_data(test_data_sets[name], input_types, output_types)
+
+    return _stress_test_data_sets(as_model_handle(model), sorted(test_data_sets), read_data_set,
+                                  thread_counts, iterations, tolerances)
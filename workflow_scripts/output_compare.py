@@ -0,0 +1,125 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+
+import numpy as np
+
+# Per-model tolerances, e.g. {"vision/classification/foo/model/foo-12-int8.tar.gz": {"float32": {"atol": 1e-2}}}.
+# The keys of a model entry are numpy dtype names of the outputs, or "default" for any float output.
+TOLERANCES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_tolerances.json")
+DEFAULT_TOLERANCES = {"default": {"rtol": 1.0e-3, "atol": 1.0e-3}}
+# integer type with the width of each float type, to count the ULPs between two floats
+_FLOAT_BITS_TYPES = {np.dtype(np.float16): np.int16, np.dtype(np.float32): np.int32, np.dtype(np.float64): np.int64}
+
+
+def load_tolerances(model_path=None, tolerances_file=TOLERANCES_FILE):
+    """Return the tolerances of a model: DEFAULT_TOLERANCES updated with the entry of model_path in
+    tolerances_file, if there is one."""
+    tolerances = dict(DEFAULT_TOLERANCES)
+    if model_path is not None and os.path.exists(tolerances_file):
+        with open(tolerances_file, "r") as f:
+            tolerances.update(json.load(f).get(model_path.replace("\\", "/"), {}))
+    return tolerances
+
+
+def get_tolerance(tolerances, dtype):
+    """Return (rtol, atol) for outputs of dtype. Only float outputs have tolerances; other types must be equal."""
+    tolerances = tolerances or DEFAULT_TOLERANCES
+    tolerance = dict(tolerances.get("default", DEFAULT_TOLERANCES["default"]))
+    tolerance.update(tolerances.get(np.dtype(dtype).name, {}))
+    return tolerance["rtol"], tolerance["atol"]
+
+
+def _to_ordered_ints(data):
+    # reinterpret floats as integers that are ordered like the floats, so that the difference of two of them
+    # is the number of representable floats between them
+    bits = data.view(_FLOAT_BITS_TYPES[data.dtype]).astype(np.int64)
+    min_int = np.iinfo(_FLOAT_BITS_TYPES[data.dtype]).min
+    return np.where(bits < 0, min_int - bits, bits)
+
+
+def _to_python(value):
+    value = value.item() if isinstance(value, np.generic) else value
+    if isinstance(value, complex):
+        return str(value)
+    if isinstance(value, float) and not np.isfinite(value):
+        return str(value)
+    return round(value, 8) if isinstance(value, float) else value
+
+
+def compare_output(name, expected, actual, tolerances=None):
+    """
+    Compare an output with its expected value using vectorized numpy operations only.
+
+    :param name: Output name.
+    :param expected: Expected numpy.ndarray.
+    :param actual: numpy.ndarray returned by the model.
+    :param tolerances: Map of dtype name or "default" to {"rtol": ..., "atol": ...}. Defaults to DEFAULT_TOLERANCES.
+    :return: Map with the result: passed, mismatches, size and, for numeric outputs, max_abs_error, max_rel_error,
+             the ULP distance for float outputs, and the worst element: its index, expected and actual value.
+    """
+    expected = np.asarray(expected)
+    actual = np.asarray(actual)
+    report = {"name": name, "dtype": expected.dtype.name, "shape": list(expected.shape)}
+    if expected.shape != actual.shape:
+        report["actual_shape"] = list(actual.shape)
+        if expected.size != actual.size:
+            report["passed"] = False
+            return report
+        # e.g. an expected output saved without its batch dim
+        actual = actual.reshape(expected.shape)
+    report["size"] = int(expected.size)
+    if expected.size == 0:
+        report.update(passed=True, mismatches=0)
+        return report
+
+    if expected.dtype.kind not in "biufc":
+        # strings and other objects can only be equal or not
+        mismatch = expected != actual
+        report.update(passed=not mismatch.any(), mismatches=int(np.count_nonzero(mismatch)))
+        return report
+
+    is_float = expected.dtype.kind in "fc"
+    # float type of the errors, e.g. float32 for float32 outputs and float64 for integers
+    compute_type = np.result_type(expected.dtype, actual.dtype, 1.0)
+    expected_values = expected.astype(compute_type)
+    actual_values = actual.astype(compute_type)
+    with np.errstate(invalid="ignore", over="ignore"):
+        abs_error = np.abs(actual_values - expected_values)
+    if is_float:
+        rtol, atol = get_tolerance(tolerances, expected.dtype)
+        mismatch = ~np.isclose(expected, actual, rtol=rtol, atol=atol)
+        report.update(rtol=rtol, atol=atol)
+    else:
+        mismatch = np.not_equal(expected, actual)
+    # NaN errors count as the worst ones
+    abs_error = np.where(np.isnan(abs_error), np.inf, abs_error)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rel_error = np.where(abs_error == 0, 0.0, abs_error / np.abs(expected_values))
+    worst = np.unravel_index(int(np.argmax(abs_error)), expected.shape)
+
+    report.update(
+        passed=not mismatch.any(),
+        mismatches=int(np.count_nonzero(mismatch)),
+        max_abs_error=_to_python(abs_error[worst]),
+        max_rel_error=_to_python(np.nanmax(rel_error)),
+        worst_index=[int(i) for i in worst],
+        expected_at_worst=_to_python(expected[worst]),
+        actual_at_worst=_to_python(actual[worst]),
+    )
+    if expected.dtype in _FLOAT_BITS_TYPES and actual.dtype == expected.dtype:
+        ulp = np.abs(_to_ordered_ints(actual) - _to_ordered_ints(expected))
+        report["max_ulp"] = int(ulp.max())
+    return report
+
+
+def compare_outputs(output_names, expected_outputs, run_outputs, tolerances=None):
+    """Return the compare_output reports of the outputs that have an expected value."""
+    return [compare_output(name, expected_outputs[name], actual, tolerances)
+            for name, actual in zip(output_names, run_outputs) if name in expected_outputs]
+
+
+def format_report(report):
+    """Return a report as one line of compact JSON."""
+    return json.dumps(report, separators=(",", ":"))
@@ -0,0 +1,269 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import check_model
+import json
+import math
+import numpy as np
+import onnxruntime
+import result_cache
+import sqlite3
+import sys
+import time
+
+PERF_DB_FILE = 'ci_perf.db'
+# one run per process and database, e.g. one test_models --benchmark invocation
+_run_ids = {}
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    label TEXT,
+    onnxruntime_version TEXT NOT NULL,
+    cpu_fingerprint TEXT NOT NULL,
+    session_profile TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    model_sha TEXT NOT NULL,
+    model_path TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    p50_ms REAL,
+    p90_ms REAL,
+    p99_ms REAL,
+    mean_ms REAL,
+    throughput REAL,
+    peak_rss_mb REAL,
+    session_creation_ms REAL,
+    latencies_ms TEXT,
+    PRIMARY KEY (run_id, model_sha, mode, variant)
+);
+CREATE INDEX IF NOT EXISTS runs_by_config ON runs (onnxruntime_version, cpu_fingerprint, session_profile);
+'''
+
+
+def connect(db_path=PERF_DB_FILE):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _get_run_id(conn, db_path, session_profile, label):
+    key = (db_path, session_profile, label)
+    if key not in _run_ids:
+        cursor = conn.execute(
+            'INSERT INTO runs (created, label, onnxruntime_version, cpu_fingerprint, session_profile) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (time.time(), label, onnxruntime.__version__, check_model.get_cpu_fingerprint(), session_profile))
+        _run_ids[key] = cursor.lastrowid
+    return _run_ids[key]
+
+
+def _get_mode_and_variant(record):
+    # the benchmark modes of test_models and batch_size_sweep, and what one record of each is measured at
+    if 'batch_size' in record:
+        return 'batch', str(record['batch_size'])
+    if 'threads' in record:
+        return 'concurrent', str(record['threads'])
+    if record.get('io_binding'):
+        # without the output allocations, so not comparable with the runs of sess.run
+        return 'latency_io_binding', record.get('test_data_set', '')
+    return 'latency', record.get('test_data_set', '')
+
+
+def add_results(records, db_path=PERF_DB_FILE, session_profile='default', label=None, manifest_shas=None):
+    """
+    Store benchmark records of test_models --benchmark/--stress_threads or batch_size_sweep.py.
+    All records stored by one process with the same session profile and label belong to one run.
+
+    :param records: List of benchmark records, each with a model_path.
+    :param db_path: SQLite database to store the records in. Created if it does not exist.
+    :param session_profile: Session profile the records were measured with.
+    :param label: Optional name of the run, e.g. a CI build number.
+    :param manifest_shas: Optional map of model path to sha256 from result_cache.load_manifest_shas.
+    """
+    if not records:
+        return
+    if manifest_shas is None:
+        manifest_shas = result_cache.load_manifest_shas()
+    with connect(db_path) as conn:
+        run_id = _get_run_id(conn, db_path, session_profile, label)
+        for record in records:
+            model_sha = result_cache.get_model_sha(record['model_path'], manifest_shas)
+            if model_sha is None:
+                # results are compared across runs by model sha
+                print('Warning: {} has no sha, so its results are not stored.'.format(record['model_path']))
+                continue
+            mode, variant = _get_mode_and_variant(record)
+            throughput = record.get('throughput_per_sec', record.get('qps', record.get('samples_per_sec')))
+            conn.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_id, model_sha, record['model_path'], mode, variant, record.get('p50_ms'), record.get('p90_ms'),
+                 record.get('p99_ms'), record.get('mean_ms'), throughput, record.get('peak_rss_mb'),
+                 record.get('session_creation_ms'), json.dumps(record.get('latencies_ms'))))
+    conn.close()
+
+
+def _rank(values):
+    # ranks starting at 1, with tied values getting the average of their ranks
+    order = np.argsort(values, kind='mergesort')
+    sorted_values = values[order]
+    ranks = np.empty(len(values))
+    start = 0
+    while start < len(values):
+        end = start
+        while end + 1 < len(values) and sorted_values[end + 1] == sorted_values[start]:
+            end += 1
+        ranks[order[start:end + 1]] = (start + end) / 2 + 1
+        start = end + 1
+    return ranks
+
+
+def mann_whitney_p_value(a, b):
+    """Return the two-sided p-value of the Mann-Whitney U test that samples a and b come from the same distribution,
+    using the normal approximation with tie correction. Latencies are skewed and have outliers, so this is used
+    instead of a t-test."""
+    n1, n2 = len(a), len(b)
+    if n1 == 0 or n2 == 0:
+        return 1.0
+    values = np.concatenate([a, b])
+    ranks = _rank(values)
+    u = ranks[:n1].sum() - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    _, tie_counts = np.unique(values, return_counts=True)
+    variance = n1 * n2 / 12 * ((n + 1) - ((tie_counts ** 3 - tie_counts).sum() / (n * (n - 1)) if n > 1 else 0))
+    if variance <= 0:
+        return 1.0
+    z = (abs(u - n1 * n2 / 2) - 0.5) / math.sqrt(variance)
+    return math.erfc(max(z, 0) / math.sqrt(2))
+
+
+def find_run(conn, run_id=None, onnxruntime_version=None, cpu_fingerprint=None, session_profile=None,
+             before_run_id=None):
+    """Return the run with run_id, or the latest run matching the given configuration, older than before_run_id
+    if it is given."""
+    if run_id is not None:
+        return conn.execute('SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone()
+    conditions, params = [], []
+    for column, value in [('onnxruntime_version', onnxruntime_version), ('cpu_fingerprint', cpu_fingerprint),
+                          ('session_profile', session_profile)]:
+        if value is not None:
+            conditions.append('{} = ?'.format(column))
+            params.append(value)
+    if before_run_id is not None:
+        conditions.append('id < ?')
+        params.append(before_run_id)
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    return conn.execute('SELECT * FROM runs {} ORDER BY id DESC LIMIT 1'.format(where), params).fetchone()
+
+
+def compare_runs(conn, baseline_run, candidate_run, threshold=0.05, alpha=0.01):
+    """
+    Compare the results that two runs have in common.
+
+    :param threshold: Smallest relative change of a metric that is reported.
+    :param alpha: Significance level of the Mann-Whitney U test on the latencies of each result. Changes of the
+                  throughput and peak RSS are only tested against threshold.
+    :return: List of maps describing the changes, with regression set for those that got worse.
+    """
+    query = 'SELECT * FROM results WHERE run_id = ?'
+    baseline = {(r['model_sha'], r['mode'], r['variant']): r for r in conn.execute(query, (baseline_run['id'],))}
+    changes = []
+    for candidate in conn.execute(query, (candidate_run['id'],)):
+        key = (candidate['model_sha'], candidate['mode'], candidate['variant'])
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        base_latencies = np.array(json.loads(base['latencies_ms']) or [])
+        candidate_latencies = np.array(json.loads(candidate['latencies_ms']) or [])
+        p_value = mann_whitney_p_value(base_latencies, candidate_latencies)
+        # metric, whether higher is better, whether the change must also pass the significance test
+        for metric, higher_is_better, tested in [('p50_ms', False, True), ('p99_ms', False, True),
+                                                 ('throughput', True, False), ('peak_rss_mb', False, False)]:
+            before, after = base[metric], candidate[metric]
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if abs(change) < threshold or (tested and p_value >= alpha):
+                continue
+            changes.append({
+                'model_path': candidate['model_path'],
+                'mode': candidate['mode'],
+                'variant': candidate['variant'],
+                'metric': metric,
+                'baseline': before,
+                'candidate': after,
+                'change': round(change, 4),
+                'p_value': round(p_value, 6) if tested else None,
+                'regression': (change < 0) if higher_is_better else (change > 0),
+            })
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and compare the performance runs stored by '
+                                                 'test_models.py --perf_db and batch_size_sweep.py --perf_db')
+    parser.add_argument('command', choices=['list', 'compare'],
+                        help='list: show the stored runs. compare: report the significant changes between two runs')
+    parser.add_argument('--db', required=False, default=PERF_DB_FILE, type=str,
+                        help='The SQLite database of the runs')
+    parser.add_argument('--baseline', required=False, default=None, type=int,
+                        help='Run id of the baseline. Defaults to the latest run of --baseline_ort, or of the '
+                             'candidate configuration, before the candidate')
+    parser.add_argument('--candidate', required=False, default=None, type=int,
+                        help='Run id to compare. Defaults to the latest run of --candidate_ort')
+    parser.add_argument('--baseline_ort', required=False, default=None, type=str,
+                        help='onnxruntime version of the baseline run, e.g. 1.16.3')
+    parser.add_argument('--candidate_ort', required=False, default=None, type=str,
+                        help='onnxruntime version of the candidate run. Defaults to the installed one')
+    parser.add_argument('--session_profile', required=False, default='default', type=str,
+                        help='Session profile of the runs found by onnxruntime version',
+                        choices=check_model.SESSION_PROFILES)
+    parser.add_argument('--threshold', required=False, default=0.05, type=float,
+                        help='Smallest relative change to report, e.g. 0.05 for 5%%')
+    parser.add_argument('--alpha', required=False, default=0.01, type=float,
+                        help='Significance level of the latency comparison')
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    if args.command == 'list':
+        for run in conn.execute('SELECT runs.*, COUNT(results.run_id) AS results FROM runs '
+                                'LEFT JOIN results ON results.run_id = runs.id GROUP BY runs.id ORDER BY runs.id'):
+            print('{id}: {created} onnxruntime {onnxruntime_version} {session_profile} {label} '
+                  '{results} results on {cpu_fingerprint}'.format(
+                      **dict(run, created=time.strftime('%Y-%m-%d %H:%M', time.localtime(run['created'])))))
+        return
+
+    # runs found by onnxruntime version are only compared on this machine
+    cpu_fingerprint = check_model.get_cpu_fingerprint()
+    candidate = find_run(conn, args.candidate, args.candidate_ort or onnxruntime.__version__, cpu_fingerprint,
+                         args.session_profile)
+    if candidate is None:
+        print('Could not find the candidate run to compare.', file=sys.stderr)
+        sys.exit(-1)
+    # without a baseline the latest run would be the candidate itself
+    baseline = find_run(conn, args.baseline, args.baseline_ort, cpu_fingerprint, args.session_profile,
+                        candidate['id'])
+    if baseline is None:
+        print('Could not find the baseline run to compare.', file=sys.stderr)
+        sys.exit(-1)
+    if baseline['cpu_fingerprint'] != candidate['cpu_fingerprint']:
+        print('Warning: the runs were measured on different CPUs.')
+    print('Comparing run {} (onnxruntime {}) with run {} (onnxruntime {})'.format(
+        baseline['id'], baseline['onnxruntime_version'], candidate['id'], candidate['onnxruntime_version']))
+    changes = compare_runs(conn, baseline, candidate, args.threshold, args.alpha)
+    for change in changes:
+        print('[{}] {} {} {}: {} {} -> {} ({:+.1%})'.format(
+            'REGRESSION' if change['regression'] else 'IMPROVEMENT', change['model_path'], change['mode'],
+            change['variant'], change['metric'], change['baseline'], change['candidate'], change['change']))
+    regressions = [change for change in changes if change['regression']]
+    print('{} regressions, {} improvements.'.format(len(regressions), len(changes) - len(regressions)))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
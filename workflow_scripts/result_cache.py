@@ -0,0 +1,155 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+import os
+import platform
+import time
+
+import onnx
+import onnxruntime
+import test_utils
+
+RESULT_CACHE_FILE = 'ci_result_cache.jsonl'
+MANIFEST_FILE = 'ONNX_HUB_MANIFEST.json'
+# (path, size, mtime) -> sha256 of the files hashed by this process
+_file_shas = {}
+
+
+def load_manifest_shas(manifest_path=MANIFEST_FILE):
+    """Return a map of model file path (.onnx and .tar.gz) to the sha256 recorded for it in the manifest."""
+    shas = {}
+    if not os.path.exists(manifest_path):
+        return shas
+    with open(manifest_path, 'r') as f:
+        for model in json.load(f):
+            metadata = model['metadata']
+            shas[model['model_path']] = metadata.get('model_sha')
+            if 'model_with_data_path' in metadata:
+                shas[metadata['model_with_data_path']] = metadata.get('model_with_data_sha')
+    return shas
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _get_file_sha(file_path, manifest_shas):
+    # the sha256 of the content of the file: the oid of its git-lfs pointer if it has not been pulled, otherwise
+    # the hash of the file, so that a model edited without updating the manifest gets a new key.
+    # The manifest is only used for files that are not on disk
+    if not os.path.exists(file_path):
+        return manifest_shas.get(file_path)
+    pointer = test_utils.read_lfs_pointer_file(file_path)
+    if pointer is not None:
+        return pointer[0]
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_size, stat.st_mtime_ns)
+    if key not in _file_shas:
+        _file_shas[key] = hash_file(file_path)
+    return _file_shas[key]
+
+
+def get_model_sha(model_path, manifest_shas):
+    """Return the sha256 of the ONNX model of a model file. For a .tar.gz this is the sha of its standalone .onnx
+    if there is one, otherwise the sha of the .tar.gz itself."""
+    if model_path.endswith('.tar.gz'):
+        model_sha = _get_file_sha(model_path[:-len('.tar.gz')] + '.onnx', manifest_shas)
+        if model_sha is not None:
+            return model_sha
+    return _get_file_sha(model_path, manifest_shas)
+
+
+def get_cache_key(model_path, target, manifest_shas, check_options=None):
+    """Return the cache key of a model file, or None if the model cannot be identified.
+    The key is (model sha, test data sha, onnx version, onnxruntime version, target, sha of the check options).
+    For a .tar.gz the model sha is the one of its standalone .onnx and the test data sha is the one of the .tar.gz
+    itself.
+
+    :param check_options: Map of the options that change what a PASS means, e.g. the ORT session profile, whether
+                          onnx.checker ran with full_check and the tolerances of the model. Must be JSON serializable.
+    """
+    if model_path.endswith('.tar.gz'):
+        test_data_sha = _get_file_sha(model_path, manifest_shas)
+        model_sha = _get_file_sha(model_path[:-len('.tar.gz')] + '.onnx', manifest_shas)
+        if test_data_sha is None:
+            return None
+    else:
+        test_data_sha = None
+        model_sha = _get_file_sha(model_path, manifest_shas)
+        if model_sha is None:
+            return None
+    options_sha = hashlib.sha256(json.dumps(check_options or {}, sort_keys=True).encode('utf-8')).hexdigest()
+    return (model_sha, test_data_sha, onnx.__version__, onnxruntime.__version__, target, options_sha)
+
+
+def _read_records(cache_path):
+    if not os.path.exists(cache_path):
+        return
+    with open(cache_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # a partially written line from an interrupted run
+                continue
+
+
+def _append_record(record, cache_path):
+    with open(cache_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def get_cpu_model():
+    """Return the model name of the CPU, e.g. from /proc/cpuinfo."""
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    return platform.processor() or 'unknown'
+
+
+def get_machine_id():
+    # with the CPU model, so that a host that moved to another CPU, e.g. a resized VM, probes its CPU again
+    return '{}/{}/{}'.format(platform.node(), platform.machine(), get_cpu_model())
+
+
+def load_cpu_capabilities(cache_path=RESULT_CACHE_FILE):
+    """Return the CPU capabilities saved for this machine, or None if they were not probed yet."""
+    capabilities = None
+    for record in _read_records(cache_path):
+        if 'cpu_capabilities' in record and record.get('machine') == get_machine_id():
+            capabilities = frozenset(record['cpu_capabilities'])
+    return capabilities
+
+
+def save_cpu_capabilities(capabilities, cache_path=RESULT_CACHE_FILE):
+    _append_record({'machine': get_machine_id(), 'cpu_capabilities': sorted(capabilities)}, cache_path)
+
+
+def load_results(cache_path=RESULT_CACHE_FILE):
+    """Return a map of cache key to the latest cached result record."""
+    results = {}
+    for record in _read_records(cache_path):
+        if 'key' in record:
+            results[tuple(record['key'])] = record
+    return results
+
+
+def append_result(key, model_path, result, seconds, cache_path=RESULT_CACHE_FILE):
+    record = {
+        'key': list(key),
+        'model_path': model_path,
+        'result': result,
+        'seconds': round(seconds, 3),
+        'timestamp': int(time.time()),
+    }
+    _append_record(record, cache_path)
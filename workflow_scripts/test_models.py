@@ -1,16 +1,35 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
+import benchmark_utils
 import check_model
+from model_handle import ModelHandle
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager, redirect_stdout
+import io
+import multiprocessing
+import multiprocessing.forkserver
 from pathlib import Path
+import queue
 import subprocess
 import sys
 import test_utils
+import threading
 import os
+import output_compare
+import perf_store
+import result_cache
+import sqlite3
+import time
 
 
 tar_ext_name = ".tar.gz"
 onnx_ext_name = ".onnx"
+# git-lfs pull and prune update the index and the working tree, so the pipeline stages take turns running them.
+# The background fetch only adds objects to .git/lfs and runs alongside the pulls; only prune, which deletes
+# objects from there, waits for it
+_lfs_lock = threading.Lock()
+_lfs_fetch_lock = threading.Lock()
 
 
 def get_all_models():
@@ -42,6 +61,294 @@ def get_changed_models():
     return model_list
 
 
+def needs_lfs_pull(model_path, args):
+    # standalone .onnx models are only pulled to be checked by onnx
+    return tar_ext_name in model_path or args.target == "onnx" or args.target == "all"
+
+
+def prepare_model(model_path, args, workspace):
+    """Pull a model and, unless --stream is used, extract its .tar.gz into the scratch workspace.
+    Return the ONNX model path and the test_data_set directories extracted from the .tar.gz."""
+    if needs_lfs_pull(model_path, args):
+        with _lfs_lock:
+            test_utils.pull_lfs_file(model_path)
+    if tar_ext_name in model_path and not args.stream:
+        # check whether "test_data_set_0" exists
+        return test_utils.extract_test_data(model_path, workspace)
+    return None, []
+
+
+def save_results(records, model_path, output_path, args):
+    """Append the benchmark or stress test records of a model to output_path and --perf_db. A results file that
+    can't be written is reported, but doesn't fail the model."""
+    for record in records:
+        record["model_path"] = model_path
+        record["session_profile"] = args.session_profile
+    try:
+        benchmark_utils.write_results(records, output_path)
+    except (OSError, ValueError) as e:
+        print("Warning: could not write the results of {} to {}: {}".format(model_path, output_path, e))
+    if args.perf_db:
+        try:
+            perf_store.add_results(records, args.perf_db, args.session_profile, args.perf_label)
+        except sqlite3.Error as e:
+            print("Warning: could not store the results of {} in {}: {}".format(model_path, args.perf_db, e))
+
+
+def test_model(model_path, args, workspace, model_path_from_tar, test_data_set):
+    """Check a model prepared by prepare_model. Raises on failure."""
+    model_name = model_path.split("/")[-1]
+    session_options = check_model.get_session_options(args.session_profile, args.jobs)
+    tolerances = output_compare.load_tolerances(model_path)
+    # check .tar.gz by ORT and ONNX
+    if tar_ext_name in model_name:
+        # Step 1: check the ONNX model and test_data_set from .tar.gz by ORT
+        if args.stream:
+            # read the model and test data straight out of the .tar.gz without extracting it
+            onnx_model_name, model_bytes, test_data_sets = test_utils.stream_test_data(model_path)
+            model = ModelHandle(onnx_model_name, model_bytes, session_options)
+        else:
+            model = ModelHandle(model_path_from_tar, session_options=session_options)
+        # if tar.gz exists, git pull and try to get test data
+        if (args.target == "onnxruntime" or args.target == "all"):
+            # finally check the ONNX model from .tar.gz by ORT
+            # if the test_data_set does not exist, create the test_data_set
+            try:
+                if args.stream:
+                    check_model.run_backend_ort_on_test_data(model, test_data_sets, tolerances, args.stack_batches,
+                                                             args.io_binding)
+                else:
+                    check_model.run_backend_ort(model, test_data_set, workspace=workspace, tolerances=tolerances,
+                                                stack_batches=args.stack_batches, io_binding=args.io_binding)
+                print("[PASS] {} is checked by onnxruntime. ".format(model_name))
+            except Exception as e:
+                if not args.create:
+                    raise
+                else:
+                    print("Warning: original test data for {} is broken: {}".format(model_path, e))
+                    test_utils.remove_onnxruntime_test_dir(workspace)
+                if not model.on_disk:
+                    # creating the test data needs the model on disk
+                    model_path_from_tar, _ = test_utils.extract_test_data(model_path, workspace)
+                    model = ModelHandle(model_path_from_tar, session_options=session_options)
+                if (not model_name.endswith("-int8.tar.gz") and not model_name.endswith("-qdq.tar.gz")) or check_model.has_vnni_support():
+                    check_model.run_backend_ort(model, None, model_path, workspace, args.test_data_format,
+                                                tolerances, io_binding=args.io_binding)
+                else:
+                    print("Skip quantized  models because their test_data_set was created in avx512vnni machines. ")
+                print("[PASS] {} is checked by onnxruntime. ".format(model_name))
+            if args.benchmark:
+                records = check_model.run_benchmark_ort(model, test_data_sets if args.stream else None,
+                                                        args.warmup_iterations, args.iterations, args.io_binding)
+                save_results(records, model_path, args.benchmark_output, args)
+            if args.stress_threads:
+                records = check_model.run_stress_test_ort(model, test_data_sets if args.stream else None,
+                                                          args.stress_threads, args.iterations, tolerances)
+                save_results(records, model_path, args.stress_output, args)
+        # Step 2: check the ONNX model inside .tar.gz by ONNX
+        if args.target == "onnx" or args.target == "all":
+            check_model.run_onnx_checker(model, args.full_check)
+            print("[PASS] {} is checked by onnx. ".format(model_name))
+    # check uploaded standalone ONNX model by ONNX
+    elif onnx_ext_name in model_name:
+        if args.target == "onnx" or args.target == "all":
+            check_model.run_onnx_checker(model_path, args.full_check)
+            print("[PASS] {} is checked by onnx. ".format(model_name))
+
+
+def cleanup_model(model_path, args, workspace):
+    # remove checked models and their scratch directories to save space in CIs
+    if os.path.exists(model_path) and args.drop:
+        os.remove(model_path)
+    test_utils.remove_scratch_workspace(workspace)
+    with _lfs_lock, _lfs_fetch_lock:
+        test_utils.run_lfs_prune()
+
+
+def verify_model(model_path, args, workspace, prepared):
+    """Return None if the model passed, otherwise the failure message."""
+    model_name = model_path.split("/")[-1]
+    print("==============Testing {}==============".format(model_name))
+    try:
+        test_model(model_path, args, workspace, *prepared)
+    except Exception as e:
+        print("[FAIL] {}: {}".format(model_name, e))
+        return str(e)
+    return None
+
+
+def _verify_model_in_worker(model_path, args, workspace, prepared):
+    # buffer the log of each model so that output from concurrent workers doesn't interleave
+    log = io.StringIO()
+    start = time.perf_counter()
+    with redirect_stdout(log):
+        error = verify_model(model_path, args, workspace, prepared)
+    return log.getvalue(), error, time.perf_counter() - start
+
+
+class _PipelineOutput(io.TextIOBase):
+    """Stands in for sys.stdout while the pipeline threads run. The output of each thread is written a complete
+    line at a time, or inside buffer() a complete log at a time, so the LFS messages of the producer and cleanup
+    threads don't end up in the middle of the log of the model being verified."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _emit(self, text):
+        if text:
+            with self._lock:
+                self.stream.write(text)
+                self.stream.flush()
+
+    def write(self, text):
+        pending = getattr(self._local, "pending", "") + text
+        if getattr(self._local, "buffering", False) or "\n" not in pending:
+            self._local.pending = pending
+        else:
+            lines, _, self._local.pending = pending.rpartition("\n")
+            self._emit(lines + "\n")
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            self.stream.flush()
+
+    @contextmanager
+    def buffer(self):
+        self._local.buffering = True
+        try:
+            yield
+        finally:
+            self._local.buffering = False
+            pending, self._local.pending = getattr(self._local, "pending", ""), ""
+            self._emit(pending)
+
+
+def prefetch_models(model_list, args):
+    """Yield the models in order while a background thread fetches the LFS objects of the next
+    args.lfs_batch_size models with a single git-lfs call, so the next batch downloads while the current one
+    is verified."""
+    batch_size = args.lfs_batch_size
+    if batch_size <= 0:
+        yield from model_list
+        return
+    batches = [model_list[i:i + batch_size] for i in range(0, len(model_list), batch_size)]
+
+    def fetch(batch):
+        files = [model_path for model_path in batch if needs_lfs_pull(model_path, args)]
+        if files:
+            with _lfs_fetch_lock:
+                test_utils.fetch_lfs_files(files)
+
+    with ThreadPoolExecutor(max_workers=1) as fetcher:
+        fetches = [fetcher.submit(fetch, batches[0])] if batches else []
+        for i, batch in enumerate(batches):
+            fetches[i].result()
+            if i + 1 < len(batches):
+                fetches.append(fetcher.submit(fetch, batches[i + 1]))
+            yield from batch
+
+
+def check_models(model_list, args):
+    """Check the models in a three-stage pipeline and yield (model_path, error, seconds) as they finish.
+    error is None if the model passed.
+
+    1. A producer thread pulls each model and extracts it into its own scratch workspace, staying at most
+       args.lookahead models ahead of the verifier to cap the disk usage.
+    2. The verifier checks the prepared models, inline or in a pool of args.jobs worker processes.
+    3. A cleanup thread drops the checked models, removes their workspaces and prunes LFS objects.
+    """
+    prepared_models = queue.Queue(maxsize=max(args.lookahead, 1))
+    checked_models = queue.Queue()
+
+    def produce():
+        try:
+            for model_path in prefetch_models(model_list, args):
+                workspace = test_utils.create_scratch_workspace(args.scratch_dir)
+                start = time.perf_counter()
+                try:
+                    prepared, error = prepare_model(model_path, args, workspace), None
+                except Exception as e:
+                    prepared, error = None, str(e)
+                prepared_models.put((model_path, workspace, prepared, error, time.perf_counter() - start))
+        finally:
+            prepared_models.put(None)
+
+    def clean_up():
+        while True:
+            item = checked_models.get()
+            if item is None:
+                return
+            cleanup_model(item[0], args, item[1])
+
+    def finish(future):
+        model_path, workspace, prepare_seconds = pending.pop(future)
+        try:
+            log, error, seconds = future.result()
+        except Exception as e:
+            # the worker process itself died, e.g. killed by the OOM killer
+            log, error, seconds = "", str(e), 0.0
+            print("[FAIL] {}: {}".format(model_path.split("/")[-1], e))
+        print(log, end="")
+        checked_models.put((model_path, workspace))
+        return model_path, error, prepare_seconds + seconds
+
+    executor = None
+    if args.jobs > 1:
+        # the worker processes are started on demand while the producer/cleanup threads are running, and forking
+        # this process then can deadlock the children; fork them from a fork server started before those threads
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("forkserver")
+            multiprocessing.forkserver.ensure_running()
+        else:
+            mp_context = multiprocessing.get_context("spawn")
+        executor = ProcessPoolExecutor(max_workers=args.jobs, mp_context=mp_context,
+                                       initializer=check_model.set_cpu_capabilities,
+                                       initargs=(check_model.get_cpu_capabilities(),))
+    output = _PipelineOutput(sys.stdout)
+    sys.stdout = output
+    producer = threading.Thread(target=produce, daemon=True)
+    cleaner = threading.Thread(target=clean_up, daemon=True)
+    producer.start()
+    cleaner.start()
+    pending = {}
+    try:
+        while True:
+            item = prepared_models.get()
+            if item is None:
+                break
+            model_path, workspace, prepared, error, prepare_seconds = item
+            if error is not None:
+                print("[FAIL] {}: {}".format(model_path.split("/")[-1], error))
+                checked_models.put((model_path, workspace))
+                yield model_path, error, prepare_seconds
+            elif executor is None:
+                start = time.perf_counter()
+                with output.buffer():
+                    error = verify_model(model_path, args, workspace, prepared)
+                checked_models.put((model_path, workspace))
+                yield model_path, error, prepare_seconds + time.perf_counter() - start
+            else:
+                future = executor.submit(_verify_model_in_worker, model_path, args, workspace, prepared)
+                pending[future] = (model_path, workspace, prepare_seconds)
+                # don't take more models off the queue than there are free workers
+                while len(pending) >= args.jobs:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield finish(future)
+        for future in as_completed(list(pending)):
+            yield finish(future)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        checked_models.put(None)
+        cleaner.join()
+        sys.stdout = output.stream
+        output.flush()
+
+
 def main():
     parser = argparse.ArgumentParser(description="Test settings")
     # default all: test by both onnx and onnxruntime
@@ -52,69 +359,107 @@ def main():
     # use python workflow_scripts\test_models.py --create --all_models to create broken test data by ORT
     parser.add_argument("--create", required=False, default=False, action="store_true",
                         help="Create new test data by ORT if it fails with existing test data")
+    parser.add_argument("--test_data_format", required=False, default="pb", type=str,
+                        help="Format of the test data created by --create: one .pb file per tensor, or one "
+                             "uncompressed test_data.npt container per test_data_set that is memory mapped when read",
+                        choices=["pb", "container"])
     parser.add_argument("--all_models", required=False, default=False, action="store_true",
                         help="Test all ONNX Model Zoo models instead of only chnaged models")
     parser.add_argument("--drop", required=False, default=False, action="store_true",
                         help="Drop downloaded models after verification. (For space limitation in CIs)")
+    parser.add_argument("--full_check", required=False, default=False, action="store_true",
+                        help="Also run strict shape inference in onnx.checker")
+    parser.add_argument("--jobs", required=False, default=1, type=int,
+                        help="Number of worker processes used to check models concurrently")
+    parser.add_argument("--stream", required=False, default=False, action="store_true",
+                        help="Read the model and test data from .tar.gz files in memory instead of extracting them to disk")
+    parser.add_argument("--stack_batches", required=False, default=False, action="store_true",
+                        help="Run the test_data_set_N of a model with a dynamic batch axis as one batch when their "
+                             "inputs only differ in the batch size")
+    parser.add_argument("--io_binding", required=False, default=False, action="store_true",
+                        help="Run the models through IOBinding with output buffers that are allocated once and reused "
+                             "by every test_data_set and benchmark iteration, and report the allocations saved")
+    parser.add_argument("--session_profile", required=False, default="default", type=str,
+                        help="SessionOptions of the ORT checks. fast-verify uses basic graph optimizations and a "
+                             "bounded thread count",
+                        choices=check_model.SESSION_PROFILES)
+    parser.add_argument("--lookahead", required=False, default=2, type=int,
+                        help="Number of models pulled and extracted ahead of the verification. "
+                             "Bounds the disk usage together with --jobs")
+    parser.add_argument("--lfs_batch_size", required=False, default=8, type=int,
+                        help="Number of models whose LFS objects are fetched together, one batch ahead of the "
+                             "verification. 0 disables the prefetch")
+    parser.add_argument("--no_cache", required=False, default=False, action="store_true",
+                        help="Check every model even if it passed before with the same model, test data, "
+                             "onnx/onnxruntime versions and target")
+    parser.add_argument("--cache_file", required=False, default=result_cache.RESULT_CACHE_FILE, type=str,
+                        help="JSON-lines file to keep the verification results in")
+    parser.add_argument("--scratch_dir", required=False, default=None, type=str,
+                        help="Parent directory for the per-model scratch workspaces, e.g. a tmpfs mount like /dev/shm. "
+                             "Defaults to the system temp directory")
+    parser.add_argument("--benchmark", required=False, default=False, action="store_true",
+                        help="Also measure the latency and throughput of each model that passes the ORT check, "
+                             "using the inputs of its test_data_set_N")
+    parser.add_argument("--warmup_iterations", required=False, default=5, type=int,
+                        help="Number of untimed runs per test_data_set before the benchmark")
+    parser.add_argument("--iterations", required=False, default=20, type=int,
+                        help="Number of timed runs per test_data_set in the benchmark, and per thread in the "
+                             "stress test")
+    parser.add_argument("--stress_threads", required=False, default=None,
+                        type=lambda s: [int(item) for item in s.split(",")],
+                        help="Comma separated thread counts, e.g. 1,2,4,8. Replay the test_data_set_N of each model "
+                             "that passes the ORT check from that many threads against one shared session, "
+                             "check the outputs and record the throughput and tail latency")
+    parser.add_argument("--benchmark_output", required=False, default=benchmark_utils.BENCHMARK_FILE, type=str,
+                        help="File to append the benchmark results to. CSV if it ends with .csv, "
+                             "otherwise JSON lines")
+    parser.add_argument("--stress_output", required=False, default=benchmark_utils.STRESS_FILE, type=str,
+                        help="File to append the --stress_threads results to. CSV if it ends with .csv, "
+                             "otherwise JSON lines")
+    parser.add_argument("--perf_db", required=False, default=None, type=str,
+                        help="SQLite database to also store the --benchmark and --stress_threads results in, "
+                             "to compare them with perf_store.py compare")
+    parser.add_argument("--perf_label", required=False, default=None, type=str,
+                        help="Name of the run in --perf_db, e.g. a CI build number")
     args = parser.parse_args()
+    if (args.benchmark or args.stress_threads) and args.jobs > 1:
+        parser.error("--benchmark and --stress_threads need --jobs 1; concurrent checks would distort the latency")
 
     model_list = get_all_models() if args.all_models else get_changed_models()
     # run lfs install before starting the tests
     test_utils.run_lfs_install()
 
     print("\n=== Running test on ONNX models ===\n")
-    failed_models = []
+    # --no_cache also probes the CPU again instead of reusing the capabilities saved in the cache file
+    cpu_capabilities = check_model.get_cpu_capabilities(None if args.no_cache else args.cache_file)
+    print("CPU capabilities: {}".format(", ".join(sorted(cpu_capabilities))))
+    manifest_shas = result_cache.load_manifest_shas()
+    # the benchmark and the stress test measure every model, so they can't skip the ones that passed before.
+    # Their results are still recorded in the cache
+    use_cache = not (args.no_cache or args.benchmark or args.stress_threads)
+    cached_results = result_cache.load_results(args.cache_file) if use_cache else {}
+    # the options that change what a PASS means. The tolerances of each model are added to them
+    check_options = {"session_profile": args.session_profile, "full_check": args.full_check, "stream": args.stream,
+                     "stack_batches": args.stack_batches, "io_binding": args.io_binding}
+    cache_keys = {}
+    models_to_check = []
     for model_path in model_list:
-        model_name = model_path.split("/")[-1]
-        print("==============Testing {}==============".format(model_name))
+        model_options = dict(check_options, tolerances=output_compare.load_tolerances(model_path))
+        cache_keys[model_path] = result_cache.get_cache_key(model_path, args.target, manifest_shas, model_options)
+        cached = cached_results.get(cache_keys[model_path])
+        if cached is not None and cached["result"] == "PASS":
+            print("[CACHED] {} passed before with the same model, test data and versions. ".format(model_path))
+        else:
+            models_to_check.append(model_path)
 
-        try:
-            # check .tar.gz by ORT and ONNX
-            if tar_ext_name in model_name:
-                # Step 1: check the ONNX model and test_data_set from .tar.gz by ORT
-                test_data_set = []
-                test_utils.pull_lfs_file(model_path)
-                # check whether "test_data_set_0" exists
-                model_path_from_tar, test_data_set = test_utils.extract_test_data(model_path)
-                # if tar.gz exists, git pull and try to get test data
-                if (args.target == "onnxruntime" or args.target == "all"):
-                    # finally check the ONNX model from .tar.gz by ORT
-                    # if the test_data_set does not exist, create the test_data_set
-                    try:
-                        check_model.run_backend_ort(model_path_from_tar, test_data_set)
-                        print("[PASS] {} is checked by onnxruntime. ".format(model_name))
-                    except Exception as e:
-                        if not args.create:
-                            raise
-                        else:
-                            print("Warning: original test data for {} is broken: {}".format(model_path, e))
-                            test_utils.remove_onnxruntime_test_dir()
-                        if (not model_name.endswith("-int8.tar.gz") and not model_name.endswith("-qdq.tar.gz")) or check_model.has_vnni_support():
-                            check_model.run_backend_ort(model_path_from_tar, None, model_path)
-                        else:
-                            print("Skip quantized  models because their test_data_set was created in avx512vnni machines. ")
-                        print("[PASS] {} is checked by onnxruntime. ".format(model_name))
-                # Step 2: check the ONNX model inside .tar.gz by ONNX
-                if args.target == "onnx" or args.target == "all":
-                    check_model.run_onnx_checker(model_path_from_tar)
-                    print("[PASS] {} is checked by onnx. ".format(model_name))
-            # check uploaded standalone ONNX model by ONNX
-            elif onnx_ext_name in model_name:
-                if args.target == "onnx" or args.target == "all":
-                    test_utils.pull_lfs_file(model_path)
-                    check_model.run_onnx_checker(model_path)
-                    print("[PASS] {} is checked by onnx. ".format(model_name))
-
-        except Exception as e:
-            print("[FAIL] {}: {}".format(model_name, e))
+    failed_models = []
+    for model_path, error, seconds in check_models(models_to_check, args):
+        if error is not None:
             failed_models.append(model_path)
-
-        # remove checked models and directories to save space in CIs
-        if os.path.exists(model_path) and args.drop:
-            os.remove(model_path)
-        test_utils.remove_onnxruntime_test_dir()
-        test_utils.remove_tar_dir()
-        test_utils.run_lfs_prune()
+        # --create rewrites the .tar.gz, so its sha in the manifest no longer describes what was checked
+        if cache_keys[model_path] is not None and not args.create:
+            result_cache.append_result(cache_keys[model_path], model_path, "PASS" if error is None else "FAIL",
+                                       seconds, args.cache_file)
 
     if len(failed_models) == 0:
         print("{} models have been checked. ".format(len(model_list)))
@@ -3,18 +3,40 @@
 from pathlib import Path
 import subprocess
 import tarfile
+import tempfile
 import os
 from shutil import rmtree
+from onnx_test_data_utils import TEST_DATA_CONTAINER_FILE
 
 TEST_ORT_DIR = 'ci_test_dir'
 TEST_TAR_DIR = 'ci_test_tar_dir'
 cwd_path = Path.cwd()
+# git-lfs pointer files are smaller than this, see the git-lfs specification
+LFS_POINTER_MAX_BYTES = 1024
 
 
 def get_model_directory(model_path):
     return os.path.dirname(model_path)
 
 
+def create_scratch_workspace(root=None):
+    """Create a unique scratch directory for checking one model.
+    root is the parent directory to create it in, e.g. a tmpfs mount such as /dev/shm."""
+    return tempfile.mkdtemp(prefix="ci_test_", dir=root)
+
+
+def remove_scratch_workspace(workspace):
+    rmtree(workspace, ignore_errors=True)
+
+
+def get_tar_dir(workspace=None):
+    return TEST_TAR_DIR if workspace is None else os.path.join(workspace, TEST_TAR_DIR)
+
+
+def get_ort_dir(workspace=None):
+    return TEST_ORT_DIR if workspace is None else os.path.join(workspace, TEST_ORT_DIR)
+
+
 def run_lfs_install():
     result = subprocess.run(['git', 'lfs', 'install'], cwd=cwd_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     print(f'Git LFS install completed with return code= {result.returncode}')
@@ -25,16 +47,106 @@ def pull_lfs_file(file_name):
     print(f'LFS pull completed for {file_name} with return code= {result.returncode}')
 
 
+def pull_lfs_files(file_names):
+    # one git-lfs call for several files instead of paying the LFS negotiation per file
+    result = subprocess.run(['git', 'lfs', 'pull', '--include', ','.join(file_names), '--exclude', '\'\''], cwd=cwd_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    print(f'LFS pull completed for {len(file_names)} files with return code= {result.returncode}')
+
+
+def fetch_lfs_files(file_names):
+    # only download the LFS objects into .git/lfs; a later pull_lfs_file then checks them out without network access
+    result = subprocess.run(['git', 'lfs', 'fetch', '--include', ','.join(file_names), '--exclude', '\'\''], cwd=cwd_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    print(f'LFS fetch completed for {len(file_names)} files with return code= {result.returncode}')
+
+
+def _parse_lfs_pointer(data):
+    # the pointer file format is described in https://github.com/git-lfs/git-lfs/blob/main/docs/spec.md
+    fields = dict(line.split(' ', 1) for line in data.decode('utf-8', 'replace').splitlines() if ' ' in line)
+    if not fields.get('version', '').startswith('https://git-lfs.github.com/spec/') or \
+            not fields.get('oid', '').startswith('sha256:') or not fields.get('size', '').isdigit():
+        return None
+    return fields['oid'][len('sha256:'):], int(fields['size'])
+
+
+def read_lfs_pointer_file(file_name):
+    """Return (sha256, size) of the payload if file_name is a git-lfs pointer that has not been pulled yet,
+    otherwise None."""
+    if os.path.getsize(file_name) > LFS_POINTER_MAX_BYTES:
+        return None
+    with open(file_name, 'rb') as f:
+        return _parse_lfs_pointer(f.read())
+
+
+def read_lfs_pointers(patterns=('*.onnx', '*.tar.gz')):
+    """Return a map of file path to (sha256, size) of the files matching patterns, read from the git-lfs pointers
+    staged in the git index without downloading the files. Files that are not stored in git-lfs are left out."""
+    result = subprocess.run(['git', 'ls-files', '-s', '-z', '--'] + list(patterns), cwd=cwd_path,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(f'git ls-files failed with return code= {result.returncode}')
+        return {}
+    paths = {}
+    for entry in result.stdout.decode('utf-8').split('\0'):
+        if entry:
+            info, path = entry.split('\t', 1)
+            paths.setdefault(info.split()[1], []).append(path)
+    if not paths:
+        return {}
+
+    # check the blob sizes first, so that only the blobs small enough to be pointers are read
+    result = subprocess.run(['git', 'cat-file', '--batch-check'], input='\n'.join(paths).encode('utf-8'),
+                            cwd=cwd_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    pointer_blobs = [line.split()[0] for line in result.stdout.decode('utf-8').splitlines()
+                     if len(line.split()) == 3 and int(line.split()[2]) <= LFS_POINTER_MAX_BYTES]
+    result = subprocess.run(['git', 'cat-file', '--batch'], input='\n'.join(pointer_blobs).encode('utf-8'),
+                            cwd=cwd_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    pointers = {}
+    output = result.stdout
+    pos = 0
+    while pos < len(output):
+        header_end = output.index(b'\n', pos)
+        blob, _, size = output[pos:header_end].decode('utf-8').split()
+        pos = header_end + 1 + int(size) + 1
+        pointer = _parse_lfs_pointer(output[header_end + 1:header_end + 1 + int(size)])
+        if pointer is not None:
+            for path in paths[blob]:
+                pointers[path] = pointer
+    return pointers
+
+
 def run_lfs_prune():
     result = subprocess.run(['git', 'lfs', 'prune'], cwd=cwd_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     print(f'LFS prune completed with return code= {result.returncode}')
 
 
-def extract_test_data(file_path):
+def extract_test_data(file_path, workspace=None):
+    tar_dir = get_tar_dir(workspace)
     tar = tarfile.open(file_path, "r:gz")
-    tar.extractall(TEST_TAR_DIR)
+    tar.extractall(tar_dir)
     tar.close()
-    return get_model_and_test_data(TEST_TAR_DIR)
+    return get_model_and_test_data(tar_dir)
+
+
+def stream_test_data(file_path):
+    """Read the ONNX model and the test_data_set_* .pb files (or test data containers) from a .tar.gz in one streaming
+    pass without extracting it to disk. Return the model file name, the model bytes and a map of test_data_set name
+    to a map of .pb file name to file bytes."""
+    onnx_model_name = None
+    onnx_model_bytes = None
+    test_data_sets = {}
+    with tarfile.open(file_path, "r|gz") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            parts = member.name.split("/")
+            file_name = parts[-1]
+            if file_name.endswith('.onnx'):
+                assert onnx_model_bytes is None, "More than one ONNX model detected"
+                onnx_model_name = file_name
+                onnx_model_bytes = tar.extractfile(member).read()
+            elif (file_name.endswith('.pb') or file_name == TEST_DATA_CONTAINER_FILE) and len(parts) > 1 and parts[-2].startswith('test_data_set_'):
+                test_data_sets.setdefault(parts[-2], {})[file_name] = tar.extractfile(member).read()
+    return onnx_model_name, onnx_model_bytes, test_data_sets
 
 
 def get_model_and_test_data(directory_path):
@@ -54,11 +166,13 @@ def get_model_and_test_data(directory_path):
     return onnx_model, test_data_set
 
 
-def remove_tar_dir():
-    if os.path.exists(TEST_TAR_DIR) and os.path.isdir(TEST_TAR_DIR):
-        rmtree(TEST_TAR_DIR)
+def remove_tar_dir(workspace=None):
+    tar_dir = get_tar_dir(workspace)
+    if os.path.exists(tar_dir) and os.path.isdir(tar_dir):
+        rmtree(tar_dir)
 
 
-def remove_onnxruntime_test_dir():
-    if os.path.exists(TEST_ORT_DIR) and os.path.isdir(TEST_ORT_DIR):
-        rmtree(TEST_ORT_DIR)
+def remove_onnxruntime_test_dir(workspace=None):
+    ort_dir = get_ort_dir(workspace)
+    if os.path.exists(ort_dir) and os.path.isdir(ort_dir):
+        rmtree(ort_dir)